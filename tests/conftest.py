@@ -0,0 +1,32 @@
+import pytest
+import fakeredis
+
+from workload import deferred_job, distributed_job
+
+
+@pytest.fixture
+def redis_server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def redis_client(redis_server):
+    """
+    In-memory redis with lua scripting, requires fakeredis[lua]
+    """
+    client = fakeredis.FakeStrictRedis(server=redis_server)
+    # scripts of the library call redis.replicate_commands for redis versions before 5, fakeredis lacks it
+    client.eval('redis.replicate_commands = function() return true end', 0)
+    return client
+
+
+@pytest.fixture
+def async_redis(redis_server, redis_client, monkeypatch):
+    """
+    Asyncio engines connect to the same in-memory redis as redis_client
+    """
+    def create_async_redis(redis_pool):
+        return fakeredis.FakeAsyncRedis(server=redis_server)
+
+    monkeypatch.setattr(deferred_job, 'create_async_redis', create_async_redis)
+    monkeypatch.setattr(distributed_job, 'create_async_redis', create_async_redis)
@@ -0,0 +1,71 @@
+import json
+import time
+import pytest
+
+pytest.importorskip('falcon')
+
+from workload.metrics import BUCKET_FIELDS  # noqa: E402
+from workload.admin.app import StatusBroadcaster, format_metrics  # noqa: E402
+
+
+class Collector:
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.collected = 0
+
+    def collect(self):
+        self.collected += 1
+        return self.statuses[min(self.collected, len(self.statuses)) - 1]
+
+
+def parse_event(event):
+    assert event.startswith(b'data: ')
+    return json.loads(event[len(b'data: '):])
+
+
+def test_broadcaster_sends_changed_jobs_only():
+    collector = Collector([
+        {'a': {'queue': 1}, 'b': {'queue': 2}},
+        {'a': {'queue': 1}, 'b': {'queue': 3}},
+    ])
+    events = StatusBroadcaster(collector, interval=0.01).subscribe()
+
+    assert parse_event(next(events)) == {'a': {'queue': 1}, 'b': {'queue': 2}}
+    assert parse_event(next(events)) == {'b': {'queue': 3}}
+    events.close()
+
+    # collector loop stops once nobody is subscribed
+    time.sleep(0.05)
+    collected = collector.collected
+    time.sleep(0.05)
+    assert collector.collected == collected
+
+
+def test_broadcaster_shares_collector_loop():
+    collector = Collector([{'a': {'queue': 1}}])
+    broadcaster = StatusBroadcaster(collector, interval=0.05)
+    first, second = broadcaster.subscribe(), broadcaster.subscribe()
+
+    assert parse_event(next(first)) == parse_event(next(second)) == {'a': {'queue': 1}}
+    time.sleep(0.2)
+    first.close()
+    second.close()
+    # a single loop collects status for both subscribers
+    assert collector.collected <= 6
+
+
+def test_format_metrics_has_cumulative_buckets():
+    buckets = [0] * len(BUCKET_FIELDS)
+    buckets[0], buckets[2] = 3, 1
+    status = {
+        'type': 'distributed', 'workload': 5, 'dead': 1, 'throughput': 0.5,
+        'latency': {'buckets': buckets, 'sum': 0.04, 'count': 4},
+    }
+
+    lines = format_metrics({'job': status}).splitlines()
+
+    assert 'workload_task_duration_seconds_bucket{{job="job",le="{}"}} 3'.format(BUCKET_FIELDS[1]) in lines
+    assert 'workload_task_duration_seconds_bucket{job="job",le="+Inf"} 4' in lines
+    assert 'workload_task_duration_seconds_count{job="job"} 4' in lines
+    assert 'workload_queued_tasks{job="job"} 5' in lines
+    assert 'workload_task_throughput{job="job"} 0.5' in lines
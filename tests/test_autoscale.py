@@ -0,0 +1,54 @@
+import pytest
+
+from workload.autoscale import Autoscale
+
+
+def finish_calls(autoscale, calls, elapsed=0.01, errors=0):
+    for index in range(calls):
+        autoscale.after_call('job', 1, elapsed, Exception('failed') if index < errors else None, None)
+
+
+def test_limit_grows_by_one_while_backlog():
+    autoscale = Autoscale(min_threads=1, max_threads=3)
+    assert [autoscale.update(backlog=10) for _ in range(4)] == [2, 3, 3, 3]
+    assert autoscale.update(backlog=0) == 2
+    assert autoscale.decision == 'decrease, no backlog'
+
+
+def test_limit_is_cut_on_errors():
+    autoscale = Autoscale(min_threads=2, max_threads=10, max_error_rate=0.1)
+    autoscale.limit = 9
+
+    finish_calls(autoscale, 10, errors=2)
+    assert autoscale.update(backlog=10) == 4
+    finish_calls(autoscale, 10, errors=2)
+    assert autoscale.update(backlog=10) == 2
+
+    # calls are counted since the last update only
+    finish_calls(autoscale, 10, errors=1)
+    assert autoscale.update(backlog=10) == 3
+
+
+def test_limit_is_cut_on_latency():
+    autoscale = Autoscale(max_threads=10, target_latency=0.5)
+    autoscale.limit = 8
+
+    finish_calls(autoscale, 4, elapsed=1)
+    assert autoscale.update(backlog=10) == 4
+    assert autoscale.decision == 'decrease, latency 1.000s'
+
+
+def test_parked_threads_wait_until_active():
+    autoscale = Autoscale(min_threads=1, max_threads=2)
+    assert autoscale.is_active(0)
+    assert not autoscale.wait_active(1, timeout=0.01)
+
+    autoscale.update(backlog=1)
+    assert autoscale.wait_active(1, timeout=0.01)
+
+
+def test_thread_bounds_are_checked():
+    with pytest.raises(Exception):
+        Autoscale(min_threads=0)
+    with pytest.raises(Exception):
+        Autoscale(min_threads=3, max_threads=2)
@@ -0,0 +1,57 @@
+import pytest
+
+from workload.codec import CompressedCodec, get_codec
+
+
+@pytest.mark.parametrize('name, value', [
+    ('raw', b'\x00\xffbytes'),
+    ('text', 'text é'),
+    ('json', {'a': [1, 2.5, None, 'b']}),
+    ('pickle', {'a': (1, 2), 'b': {3}}),
+])
+def test_round_trip(name, value):
+    codec = get_codec(name)
+    data = codec.encode(value)
+    assert isinstance(data, bytes)
+    assert codec.decode(data) == value
+
+
+def test_encoding_is_deterministic():
+    codec = get_codec('json')
+    assert codec.encode({'a': 1}) == codec.encode({'a': 1})
+
+
+def test_raw_encodes_text():
+    assert get_codec('raw').encode('item') == b'item'
+    assert get_codec('raw').encode(5) == b'5'
+
+
+def test_msgpack_round_trip():
+    pytest.importorskip('msgpack')
+    codec = get_codec('msgpack')
+    assert codec.decode(codec.encode({'a': [1, b'b']})) == {'a': [1, b'b']}
+
+
+def test_compressed_round_trip():
+    codec = CompressedCodec('json', threshold=64)
+    small = {'a': 1}
+    large = {'a': 'x' * 1000}
+
+    data = codec.encode(small)
+    assert data[:1] == CompressedCodec.PLAIN
+    assert codec.decode(data) == small
+
+    data = codec.encode(large)
+    assert data[:1] == CompressedCodec.MARKERS['zlib']
+    assert len(data) < 1000
+    assert codec.decode(data) == large
+
+
+def test_compressed_rejects_other_marker():
+    with pytest.raises(Exception):
+        CompressedCodec('raw').decode(b'\x02data')
+
+
+def test_unknown_codec():
+    with pytest.raises(Exception):
+        get_codec('unknown')
@@ -0,0 +1,103 @@
+import pytest
+
+from datetime import datetime, timedelta
+from workload.cycle import At, Interval, Task, LUA_CLAIM_DUE, fire_due
+
+
+class Job:
+    def __init__(self, name):
+        self.name = name
+        self.deferred = 0
+
+    def defer(self):
+        self.deferred += 1
+
+
+def test_at_schedules_later_today():
+    at = At(hour=9, minute=30, second=15)
+    now = datetime(2024, 1, 1, 8, 0)
+    assert at.schedule(prev=now, now=now) == datetime(2024, 1, 1, 9, 30, 15)
+
+
+def test_at_schedules_tomorrow_once_passed():
+    at = At(hour=9, minute=30, second=15)
+    assert at.schedule(prev=None, now=datetime(2024, 1, 1, 9, 30, 15)) == datetime(2024, 1, 2, 9, 30, 15)
+    assert at.schedule(prev=None, now=datetime(2024, 1, 1, 23, 0)) == datetime(2024, 1, 2, 9, 30, 15)
+
+
+def test_at_skips_days_missed_during_pause():
+    at = At(hour=6)
+    prev = datetime(2024, 1, 1, 6)
+    assert at.schedule(prev=prev, now=datetime(2024, 1, 5, 7)) == datetime(2024, 1, 6, 6)
+
+
+def test_interval_keeps_grid():
+    interval = Interval(minutes=5)
+    prev = datetime(2024, 1, 1, 0, 0)
+    # late wake up does not shift the next run
+    assert interval.schedule(prev=prev, now=prev + timedelta(seconds=0.3)) == datetime(2024, 1, 1, 0, 5)
+    assert interval.schedule(prev=prev, now=prev + timedelta(minutes=5)) == datetime(2024, 1, 1, 0, 10)
+
+
+def test_interval_skips_runs_missed_during_pause():
+    interval = Interval(minutes=5)
+    prev = datetime(2024, 1, 1, 0, 0)
+    assert interval.schedule(prev=prev, now=datetime(2024, 1, 1, 0, 17)) == datetime(2024, 1, 1, 0, 20)
+
+
+def test_interval_should_be_positive():
+    with pytest.raises(Exception):
+        Interval()
+
+
+def test_fire_due_defers_every_due_task_once():
+    now = datetime(2024, 1, 1, 0, 10)
+    first, second, later = Job('first'), Job('second'), Job('later')
+    queue = [
+        Task(now - timedelta(minutes=7), Interval(minutes=1), first, 0),
+        Task(now, Interval(minutes=5), second, 1),
+        Task(now + timedelta(seconds=30), Interval(minutes=1), later, 2),
+    ]
+
+    assert fire_due(queue, now) == 30
+    assert (first.deferred, second.deferred, later.deferred) == (1, 1, 0)
+    assert sorted(task.at for task in queue) == [
+        now + timedelta(seconds=30), now + timedelta(minutes=1), now + timedelta(minutes=5),
+    ]
+
+
+def redis_time(redis_client):
+    seconds, microseconds = redis_client.time()
+    return seconds + microseconds / 1000000
+
+
+def test_claim_due_claims_known_tasks(redis_client):
+    func_claim_due = redis_client.register_script(LUA_CLAIM_DUE)
+    now = redis_time(redis_client)
+    redis_client.zadd('cycle.schedule', {'known:interval:10': now - 25, 'other:interval:10': now - 1})
+    redis_client.hset('cycle.periods', mapping={'known:interval:10': 10, 'other:interval:10': 10})
+
+    claimed, next_in = func_claim_due(
+        keys=['cycle.schedule', 'cycle.periods'], args=[60, 1000, 'known:interval:10', 'missing:interval:1']
+    )
+
+    assert claimed == [b'known:interval:10']
+    # moved to the next run on the grid, missed runs are skipped
+    assert 4.9 < float(next_in) <= 5
+    assert abs(redis_client.zscore('cycle.schedule', 'known:interval:10') - (now + 5)) < 0.01
+    # task of another process is left to it
+    assert redis_client.zscore('cycle.schedule', 'other:interval:10') == now - 1
+
+
+def test_claim_due_prunes_stale_tasks(redis_client):
+    func_claim_due = redis_client.register_script(LUA_CLAIM_DUE)
+    now = redis_time(redis_client)
+    redis_client.zadd('cycle.schedule', {'removed:interval:10': now - 120})
+    redis_client.hset('cycle.periods', 'removed:interval:10', 10)
+
+    claimed, next_in = func_claim_due(keys=['cycle.schedule', 'cycle.periods'], args=[60, 1000])
+
+    assert claimed == []
+    assert next_in is None
+    assert redis_client.zcard('cycle.schedule') == 0
+    assert redis_client.hlen('cycle.periods') == 0
@@ -0,0 +1,170 @@
+import time
+import asyncio
+import pytest
+
+from datetime import datetime, timedelta
+from workload.deferred_job import (
+    LUA_DELAY, LUA_PROMOTE, DeferredJob, DeferredPool, get_due_time, pack_task, unpack_task,
+)
+
+
+def test_unpack_plain_task():
+    assert unpack_task(b'{"a": 1}') == (b'{"a": 1}', 0)
+
+
+def test_pack_round_trip():
+    payload = b'#payload:with:colons'
+    assert unpack_task(pack_task(payload, 3)) == (payload, 3)
+
+
+def test_pack_keeps_equal_payloads_apart():
+    assert pack_task(b'payload', 1) != pack_task(b'payload', 1)
+
+
+def test_deferred_payload_starting_with_marker(redis_client):
+    job = DeferredJob('marker', lambda workload: None, redis_pool=redis_client.connection_pool, codec='raw')
+    job.defer(b'#1:token:payload')
+    assert unpack_task(redis_client.lpop(job.queue)) == (b'#1:token:payload', 0)
+
+
+def redis_time(redis_client):
+    seconds, microseconds = redis_client.time()
+    return seconds + microseconds / 1000000
+
+
+def test_due_time():
+    assert get_due_time() is None
+    assert get_due_time(delay=timedelta(minutes=1)) == (60, True)
+    # naive datetime is considered UTC
+    assert get_due_time(at=datetime(2024, 1, 1, 0, 0, 30)) == (1704067230, False)
+    assert get_due_time(at=1704067230.5) == (1704067230.5, False)
+    with pytest.raises(Exception):
+        get_due_time(delay=1, at=1)
+
+
+def test_delay_notifies_only_about_earlier_task(redis_client):
+    func_delay = redis_client.register_script(LUA_DELAY)
+    now = redis_time(redis_client)
+
+    func_delay(keys=['job.delayed', 'job.notify'], args=['later', 60, 1])
+    assert now + 60 <= redis_client.zscore('job.delayed', 'later') <= redis_time(redis_client) + 60
+    assert redis_client.lpop('job.notify') == b'1'
+
+    func_delay(keys=['job.delayed', 'job.notify'], args=['latest', now + 120, 0])
+    assert redis_client.zscore('job.delayed', 'latest') == now + 120
+    assert redis_client.llen('job.notify') == 0
+
+    func_delay(keys=['job.delayed', 'job.notify'], args=['earlier', 10, 1])
+    func_delay(keys=['job.delayed', 'job.notify'], args=['earliest', 5, 1])
+    # notification list holds at most one item
+    assert redis_client.lrange('job.notify', 0, -1) == [b'1']
+
+
+def test_promote_moves_due_tasks_of_every_job(redis_client):
+    func_promote = redis_client.register_script(LUA_PROMOTE)
+    now = redis_time(redis_client)
+    redis_client.zadd('a.delayed', {'a1': now - 2, 'a2': now - 1, 'a3': now + 30})
+    redis_client.zadd('b.delayed', {'b1': now - 1, 'b2': now + 10})
+
+    promoted, next_in = func_promote(keys=['a.delayed', 'a.queue', 'b.delayed', 'b.queue'], args=[1000])
+
+    assert promoted == 2
+    assert 9 < float(next_in) <= 10
+    assert redis_client.lrange('a.queue', 0, -1) == [b'a1', b'a2']
+    assert redis_client.lrange('b.queue', 0, -1) == [b'b1']
+
+    redis_client.delete('a.delayed', 'b.delayed')
+    assert func_promote(keys=['a.delayed', 'a.queue', 'b.delayed', 'b.queue'], args=[1000]) == [0, None]
+
+
+def test_delayed_task_is_processed_once_due(redis_client):
+    processed = []
+
+    job = DeferredJob('delayed', processed.append, redis_pool=redis_client.connection_pool)
+    job.defer('later', delay=60)
+    job.defer('soon', delay=0.01)
+    job.defer('now')
+
+    time.sleep(0.02)
+    assert job.promote() == 1
+    assert job.process_one() is True
+    assert job.process_one() is True
+    assert job.process_one() is None
+    assert processed == ['now', 'soon']
+    assert redis_client.zcard(job.delayed) == 1
+
+
+def test_engines_retry_failed_task(redis_client, async_redis):
+    called = []
+
+    def callback(workload):
+        called.append(workload)
+        raise Exception('failed')
+
+    async def callback_async(workload):
+        async_job.stop_processing()
+        callback(workload)
+
+    sync_job = DeferredJob('sync', callback, redis_pool=redis_client.connection_pool, max_attempts=2)
+    async_job = DeferredJob('async', callback_async, redis_pool=redis_client.connection_pool, max_attempts=2)
+    sync_job.defer({'a': 1})
+    async_job.defer({'a': 1})
+
+    assert sync_job.process_one(worker_id='worker') is False
+    asyncio.run(async_job.process_async(reliable=True, worker_id='worker'))
+
+    assert called == [{'a': 1}, {'a': 1}]
+    for job in [sync_job, async_job]:
+        # retry is delayed by backoff, processing list is acked
+        assert redis_client.llen(job.queue) == 0
+        assert redis_client.llen('{}.processing.worker'.format(job.name)) == 0
+        retry, = redis_client.zrange(job.delayed, 0, -1)
+        assert unpack_task(retry) == (b'{"a": 1}', 1)
+
+
+def test_reclaim_returns_tasks_of_dead_workers(redis_client):
+    job = DeferredJob('reclaim', lambda workload: None, redis_pool=redis_client.connection_pool, codec='raw')
+    job.defer(b'queued')
+    redis_client.rpush('reclaim.processing.dead', b'first', b'second')
+    redis_client.rpush('reclaim.processing.alive', b'running')
+    redis_client.zadd('reclaim.consumers', {'dead': time.time() - 600, 'alive': time.time()})
+
+    assert job.reclaim() == 2
+    # reclaimed tasks are processed first, in their original order
+    assert redis_client.lrange(job.queue, 0, -1) == [b'first', b'second', b'queued']
+    assert redis_client.lrange('reclaim.processing.alive', 0, -1) == [b'running']
+    assert redis_client.zrange('reclaim.consumers', 0, -1) == [b'alive']
+
+    # restarted worker reclaims its own tasks right away
+    assert job.reclaim('alive') == 1
+    assert redis_client.llen(job.queue) == 4
+
+
+class Stop(BaseException):
+    pass
+
+
+def test_pool_does_not_wait_for_throttled_job(redis_client):
+    processed = []
+
+    def callback(workload):
+        if workload == 'stop':
+            raise Stop()
+        processed.append(workload)
+
+    throttled = DeferredJob('throttled', callback, redis_pool=redis_client.connection_pool, rate_limit=(1, 1))
+    free = DeferredJob('free', callback, redis_pool=redis_client.connection_pool)
+    for index in range(20):
+        throttled.defer('throttled')
+        free.defer('free')
+    free.defer('stop')
+
+    started = time.monotonic()
+    with pytest.raises(Stop):
+        DeferredPool(throttled, free).start_all()
+
+    assert time.monotonic() - started < 1
+    assert processed.count('free') == 20
+    assert processed.count('throttled') == 1
+    # tasks of the throttled job are not popped until the token is taken
+    assert redis_client.llen(throttled.queue) == 19
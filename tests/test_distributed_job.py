@@ -0,0 +1,287 @@
+import time
+import asyncio
+import logging
+import threading
+import pytest
+
+from workload import distributed_job
+from workload.utils import shard_of
+from workload.payload import RedisPayloadStore
+from workload.distributed_job import LUA_SPOPMOVE_MANY, LUA_EXTEND, LUA_REAP, LUA_FAIL, DistributedJob
+
+
+KEYS = ['job.workload', 'job.nack', 'job.attempts', 'job.retry', 'job.dead']
+
+
+@pytest.fixture
+def scripts(redis_client):
+    return {
+        name: redis_client.register_script(script) for name, script in [
+            ('claim', LUA_SPOPMOVE_MANY),
+            ('extend', LUA_EXTEND),
+            ('reap', LUA_REAP),
+            ('fail', LUA_FAIL),
+        ]
+    }
+
+
+def redis_time(redis_client):
+    return redis_client.time()[0]
+
+
+def test_claim_leases_tasks(redis_client, scripts):
+    redis_client.sadd('job.workload', 'a', 'b', 'c')
+
+    started = redis_time(redis_client)
+    claimed = scripts['claim'](keys=['job.workload', 'job.nack'], args=[2, 60])
+
+    assert len(claimed) == 2
+    assert redis_client.scard('job.workload') == 1
+    for item in claimed:
+        assert started + 60 <= redis_client.zscore('job.nack', item) <= redis_time(redis_client) + 60
+
+
+def test_claim_empty_workload(redis_client, scripts):
+    assert scripts['claim'](keys=['job.workload', 'job.nack'], args=[10, 60]) == []
+    assert redis_client.zcard('job.nack') == 0
+
+
+def test_extend_keeps_acked_tasks_out(redis_client, scripts):
+    redis_client.zadd('job.nack', {'a': 1})
+
+    started = redis_time(redis_client)
+    assert scripts['extend'](keys=['job.nack'], args=[60, 'a', 'acked']) == 1
+    assert redis_client.zscore('job.nack', 'a') >= started + 60
+    assert redis_client.zscore('job.nack', 'acked') is None
+
+
+def test_reap_returns_expired_leases_and_due_retries(redis_client, scripts):
+    now = redis_time(redis_client)
+    redis_client.sadd('job.workload', 'queued')
+    redis_client.zadd('job.nack', {'expired': now - 1, 'leased': now + 60})
+    redis_client.zadd('job.retry', {'due': now, 'delayed': now + 60})
+
+    reaped, retried, workload = scripts['reap'](keys=['job.workload', 'job.nack', 'job.retry'], args=[1000])
+
+    assert (reaped, retried, workload) == (1, 1, 3)
+    assert redis_client.smembers('job.workload') == {b'queued', b'expired', b'due'}
+    assert redis_client.zrange('job.nack', 0, -1) == [b'leased']
+    assert redis_client.zrange('job.retry', 0, -1) == [b'delayed']
+
+
+def test_fail_retries_with_backoff(redis_client, scripts):
+    redis_client.zadd('job.nack', {'a': 0, 'b': 0})
+
+    started = redis_time(redis_client)
+    assert scripts['fail'](keys=KEYS, args=[3, 2, 60, 'a']) == 1
+    assert redis_client.hget('job.attempts', 'a') == b'1'
+    assert started + 2 <= redis_client.zscore('job.retry', 'a') <= redis_time(redis_client) + 2
+    assert redis_client.zrange('job.nack', 0, -1) == [b'b']
+
+    started = redis_time(redis_client)
+    scripts['fail'](keys=KEYS, args=[3, 2, 60, 'a'])
+    assert started + 4 <= redis_client.zscore('job.retry', 'a') <= redis_time(redis_client) + 4
+
+
+def test_fail_moves_exhausted_tasks_to_dead(redis_client, scripts):
+    redis_client.hset('job.attempts', 'a', 2)
+
+    scripts['fail'](keys=KEYS, args=[3, 2, 60, 'a'])
+
+    assert redis_client.smembers('job.dead') == {b'a'}
+    assert redis_client.hlen('job.attempts') == 0
+    assert redis_client.zcard('job.retry') == 0
+
+
+def test_fail_without_backoff_returns_to_workload(redis_client, scripts):
+    scripts['fail'](keys=KEYS, args=[3, 0, 60, 'a'])
+
+    assert redis_client.smembers('job.workload') == {b'a'}
+    assert redis_client.zcard('job.retry') == 0
+
+
+def test_callback_acks_processed_tasks(redis_client):
+    processed = []
+
+    def callback(controller, item):
+        processed.append(item)
+        if item == 'bad':
+            raise Exception('failed')
+        controller.result(item.upper())
+
+    job = DistributedJob('ack', callback, redis_pool=redis_client, max_attempts=1)
+    job.distribute(['a', 'b', 'bad'])
+
+    assert job.callback((), prefetch=10) == 3
+    assert sorted(processed) == ['a', 'b', 'bad']
+    assert sorted(job.results) == [b'A', b'B']
+
+    description = job.describe()
+    assert (description['workload'], description['retry'], description['dead']) == (0, 0, 1)
+    assert description['in_progress'] is False
+    assert redis_client.zcard('ack.nack') == 0
+    assert job.callback(()) == 0
+
+
+def test_reap_returns_abandoned_claim(redis_client):
+    job = DistributedJob('lease', lambda controller, item: None, redis_pool=redis_client, lease_timeout=1)
+    job.distribute(['a'])
+    # claimed by a worker which died before the ack, lease of zero seconds is already expired
+    redis_client.register_script(LUA_SPOPMOVE_MANY)(keys=['lease.workload', 'lease.nack'], args=[1, 0])
+
+    assert job.reap() == 1
+    assert job.callback(()) == 1
+    assert redis_client.zcard('lease.nack') == 0
+
+
+def test_async_engine_logs_failed_processing(redis_client, async_redis, caplog):
+    class FailingStore(RedisPayloadStore):
+        async def load_async(self, redis_client, key):
+            job.stop_processing()
+            raise Exception('store is down')
+
+    async def callback(controller, item):
+        pass
+
+    job = DistributedJob(
+        'store', callback, redis_pool=redis_client, payload_store=FailingStore(threshold=1), lease_timeout=30
+    )
+    job.distribute(['a'])
+
+    with caplog.at_level(logging.ERROR, logger='distributed'):
+        asyncio.run(job.process_async())
+
+    assert 'store: failed to process, reason store is down' in caplog.messages
+    # left leased until reaped
+    assert redis_client.zcard('store.nack') == 1
+
+
+def test_idle_worker_reaps_once_per_half_lease(redis_client, monkeypatch):
+    monkeypatch.setattr(distributed_job, 'IDLE_TIMEOUT', 0.05)
+    reaps = []
+    reap_shards = DistributedJob._DistributedJob__reap_shards
+    monkeypatch.setattr(
+        DistributedJob, '_DistributedJob__reap_shards', lambda self: reaps.append(1) or reap_shards(self)
+    )
+    processed = []
+
+    job = DistributedJob('idle', lambda controller, item: processed.append(item), redis_pool=redis_client)
+    worker = threading.Thread(target=job._run_forever, args=(lambda: job.callback(()),), daemon=True)
+    worker.start()
+    time.sleep(0.3)
+    # notification wakes the worker up without reaping
+    job.distribute(['a'])
+    time.sleep(0.3)
+    job.stop_processing()
+    worker.join()
+
+    assert processed == ['a']
+    assert len(reaps) == 1
+
+
+def test_batch_acks_all_but_failed_items(redis_client):
+    def callback(controller, items):
+        if 'b' in items:
+            controller.fail('b')
+        if 'd' in items:
+            # explicitly acked items are processed even if the batch fails afterwards
+            controller.ack(*(item for item in items if item != 'd'))
+            raise Exception('failed')
+
+    job = DistributedJob('batch', callback, redis_pool=redis_client, batch_size=2)
+    job.distribute(['a', 'b', 'c', 'd', 'e', 'f'])
+
+    assert job.callback((), prefetch=6) == 6
+
+    description = job.describe()
+    assert (description['batch_success'], description['batch_errors']) == (2, 1)
+    assert redis_client.smembers('batch.workload') == {b'b', b'd'}
+    assert redis_client.zcard('batch.nack') == 0
+
+
+def test_buffered_writes_are_flushed_with_ack(redis_client):
+    written = []
+
+    def callback(controller, item):
+        controller.result(item.upper())
+        if not item.startswith('child'):
+            controller.fanout(['child-' + item])
+        # nothing is written until the ack
+        written.append(redis_client.sismember('buffered.result', item.upper()))
+        if item == 'bad':
+            raise Exception('failed')
+
+    job = DistributedJob('buffered', callback, redis_pool=redis_client, buffered=True, max_attempts=1)
+    job.distribute(['a', 'bad'])
+
+    assert job.callback((), prefetch=2) == 2
+    assert not any(written)
+    assert redis_client.smembers('buffered.result') == {b'A'}
+    # writes of the failed task are discarded
+    assert redis_client.smembers('buffered.workload') == {b'child-a'}
+
+
+def test_wait_results_is_woken_up_by_last_ack(redis_client):
+    job = DistributedJob('wait', lambda controller, item: None, redis_pool=redis_client)
+    job.distribute(['a', 'b'])
+    assert job.wait_results(timeout=0.1, poll_interval=0.05) is False
+
+    waited = []
+    waiter = threading.Thread(
+        target=lambda: waited.append(job.wait_results(timeout=10, poll_interval=10)), daemon=True
+    )
+    waiter.start()
+    time.sleep(0.1)
+    assert job.callback(()) == 1
+    assert waited == []
+
+    started = time.monotonic()
+    assert job.callback(()) == 1
+    waiter.join()
+
+    assert waited == [True]
+    # woken up by the ack rather than by polling
+    assert time.monotonic() - started < 1
+
+
+def test_iter_results_reads_result_stream(redis_client):
+    job = DistributedJob(
+        'stream', lambda controller, item: controller.result(item, item.upper()),
+        redis_pool=redis_client, result_stream=True
+    )
+    job.distribute(['a'])
+    assert list(job.iter_results(block=False)) == []
+
+    assert job.callback(()) == 1
+    # every entry holds results of a single result call
+    last_id, results = next(job.iter_results())
+    assert results == [b'a', b'A']
+
+    # reading continues after the last seen entry
+    assert list(job.iter_results(last_id=last_id, block=False)) == []
+
+    with pytest.raises(Exception):
+        next(DistributedJob('plain', lambda controller, item: None, redis_pool=redis_client).iter_results())
+
+
+def test_sharded_claim_steals_from_other_shards(redis_client):
+    processed = []
+
+    job = DistributedJob(
+        'sharded', lambda controller, item: processed.append(item), redis_pool=redis_client, shards=3
+    )
+    items = ['item{}'.format(index) for index in range(30)]
+    job.distribute(items)
+
+    shards = [{item for item in items if shard_of(item, 3) == shard} for shard in range(3)]
+    for shard, shard_items in enumerate(shards):
+        key_workload = '{{sharded:{}}}.workload'.format(shard)
+        assert redis_client.smembers(key_workload) == {item.encode('utf-8') for item in shard_items}
+    assert job.describe()['workload'] == 30
+
+    # home shard goes first, the next shards are stolen from once it runs dry
+    for shard in range(3):
+        assert job.callback((), prefetch=30, shard=0) == len(shards[shard])
+        assert set(processed) == shards[shard]
+        processed.clear()
+    assert job.callback((), shard=0) == 0
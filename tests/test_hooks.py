@@ -0,0 +1,83 @@
+import os
+import pstats
+
+from workload.hooks import ChainHooks, GuardedHooks, Hooks, SamplingProfiler
+from workload.distributed_job import DistributedJob
+
+
+class FailingHooks(Hooks):
+    def on_claim(self, job_name, count, elapsed):
+        raise Exception('on_claim')
+
+    def before_call(self, job_name, count):
+        raise Exception('before_call')
+
+    def after_call(self, job_name, count, elapsed, error, state):
+        raise Exception('after_call')
+
+    def on_ack(self, job_name, count, elapsed):
+        raise Exception('on_ack')
+
+
+class RecordingHooks(Hooks):
+    def __init__(self, state):
+        self.state = state
+        self.calls = []
+
+    def before_call(self, job_name, count):
+        return self.state
+
+    def after_call(self, job_name, count, elapsed, error, state):
+        self.calls.append((job_name, count, error, state))
+
+
+def test_failing_hooks_do_not_fail_task(redis_client):
+    job = DistributedJob(
+        'hooks', lambda controller, item: controller.result(item),
+        redis_pool=redis_client, hooks=FailingHooks(), max_attempts=1
+    )
+    job.distribute(['a'])
+
+    assert job.callback(()) == 1
+    assert list(job.results) == [b'a']
+    assert job.describe()['dead'] == 0
+
+
+def test_guarded_hooks_return_no_state_on_failure():
+    assert GuardedHooks(FailingHooks()).before_call('job', 1) is None
+
+
+def test_chain_hooks_pass_own_state():
+    first, second = RecordingHooks('first'), RecordingHooks('second')
+    hooks = ChainHooks(first, FailingHooks(), second)
+
+    state = hooks.before_call('job', 2)
+    hooks.after_call('job', 2, 0.1, None, state)
+
+    assert first.calls == [('job', 2, None, 'first')]
+    assert second.calls == [('job', 2, None, 'second')]
+
+
+def test_profiler_samples_one_call_at_a_time(tmp_path):
+    profiler = SamplingProfiler(str(tmp_path), every=1, memory=True)
+
+    state = profiler.before_call('job', 1)
+    # overlapping call is not profiled
+    assert profiler.before_call('job', 1) is None
+    sum(range(1000))
+    profiler.after_call('job', 1, 0.1, None, state)
+
+    assert sorted(os.listdir(tmp_path)) == ['job.{}.memory.txt'.format(os.getpid()), 'job.{}.prof'.format(os.getpid())]
+    assert pstats.Stats(str(tmp_path / 'job.{}.prof'.format(os.getpid()))).total_calls > 0
+    # the next call is sampled again
+    state = profiler.before_call('job', 1)
+    assert state is not None
+    profiler.after_call('job', 1, 0.1, None, state)
+
+
+def test_profiler_discards_fast_calls(tmp_path):
+    profiler = SamplingProfiler(str(tmp_path), every=1, slower_than=1)
+
+    profiler.after_call('job', 1, 0.1, None, profiler.before_call('job', 1))
+
+    assert os.listdir(tmp_path) == []
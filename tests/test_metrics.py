@@ -0,0 +1,63 @@
+import time
+
+from workload import metrics
+from workload.metrics import BUCKET_FIELDS, TaskMetrics, percentile
+from workload.utils import LATENCY_BUCKETS, THROUGHPUT_WINDOW
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return time.monotonic()
+
+
+def test_percentile_is_upper_bound_of_bucket():
+    counts = [0] * len(BUCKET_FIELDS)
+    assert percentile(counts, 0.5) is None
+
+    counts[0], counts[3] = 90, 10
+    assert percentile(counts, 0.5) == LATENCY_BUCKETS[0]
+    assert percentile(counts, 0.99) == LATENCY_BUCKETS[3]
+
+    # slower than all bounds
+    counts[-1] = 1000
+    assert percentile(counts, 0.99) == LATENCY_BUCKETS[-1]
+
+
+def test_metrics_are_flushed_once_per_interval(redis_client):
+    task_metrics = TaskMetrics('job', interval=60)
+    task_metrics.record(0.001)
+    assert len(task_metrics.flush(redis_client.pipeline())) == 0
+    assert len(task_metrics.flush(redis_client.pipeline(), force=True)) > 0
+    # nothing recorded since the last flush
+    assert len(task_metrics.flush(redis_client.pipeline(), force=True)) == 0
+
+
+def test_metrics_report_last_complete_window(redis_client, monkeypatch):
+    clock = Clock(THROUGHPUT_WINDOW * 1000)
+    monkeypatch.setattr(metrics, 'time', clock)
+
+    task_metrics = TaskMetrics('job')
+    task_metrics.record(0.001, count=2)
+    task_metrics.record(0.2)
+    task_metrics.record(1000)
+    task_metrics.flush(redis_client.pipeline(), force=True).execute()
+
+    description = task_metrics.parse_description(task_metrics.describe_commands(redis_client.pipeline()).execute())
+    # window being filled is not reported yet
+    assert (description['throughput'], description['latency_p50']) == (0, None)
+    assert description['latency']['count'] == 4
+    assert description['latency']['buckets'][0] == 2
+    assert description['latency']['buckets'][-1] == 1
+    assert abs(description['latency']['sum'] - 1000.202) < 1e-6
+
+    clock.now += THROUGHPUT_WINDOW
+    description = task_metrics.parse_description(task_metrics.describe_commands(redis_client.pipeline()).execute())
+    assert description['throughput'] == round(4 / THROUGHPUT_WINDOW, 2)
+    assert description['latency_p50'] == LATENCY_BUCKETS[0]
+    assert description['latency_p99'] == LATENCY_BUCKETS[-1]
@@ -0,0 +1,71 @@
+import os
+
+from workload.distributed_job import DistributedJob
+from workload.payload import LUA_RELEASE, RedisPayloadStore, SpoolPayloadStore
+
+
+KEYS = ['job.workload', 'job.nack', 'job.retry', 'job.dead']
+
+
+def test_release_keeps_bodies_of_queued_items(redis_client):
+    func_release = redis_client.register_script(LUA_RELEASE)
+    redis_client.set('job.payload.queued', b'body')
+    redis_client.set('job.payload.done', b'body')
+    redis_client.sadd('job.workload', '@queued')
+
+    released = func_release(keys=[*KEYS, 'job.payload.queued', 'job.payload.done'], args=[1, '@queued', '@done'])
+
+    assert released == [b'job.payload.done']
+    assert redis_client.exists('job.payload.queued', 'job.payload.done') == 1
+
+
+def test_release_leaves_deletion_to_store(redis_client):
+    func_release = redis_client.register_script(LUA_RELEASE)
+    redis_client.set('job.payload.done', b'body')
+
+    assert func_release(keys=[*KEYS, 'job.payload.done'], args=[0, '@done']) == [b'job.payload.done']
+    assert redis_client.exists('job.payload.done') == 1
+
+
+def test_redis_store_releases_bodies_on_ack(redis_client):
+    processed = []
+
+    job = DistributedJob(
+        'large', lambda controller, item: processed.append(item),
+        redis_pool=redis_client, payload_store=RedisPayloadStore(threshold=10)
+    )
+    job.distribute(['small', 'large' * 10])
+    assert len(redis_client.keys('large.payload.*')) == 1
+    assert all(len(item) < 40 for item in redis_client.smembers('large.workload'))
+
+    assert job.callback((), prefetch=2) == 2
+    assert sorted(processed) == ['large' * 10, 'small']
+    assert redis_client.keys('large.payload.*') == []
+
+
+def test_spool_store_releases_bodies_on_ack(redis_client, tmp_path):
+    processed = []
+
+    job = DistributedJob(
+        'spool', lambda controller, item: processed.append(item),
+        redis_pool=redis_client, payload_store=SpoolPayloadStore(str(tmp_path), threshold=10)
+    )
+    job.distribute(['spool' * 10])
+    assert len(os.listdir(tmp_path)) == 1
+
+    assert job.callback(()) == 1
+    assert processed == ['spool' * 10]
+    assert os.listdir(tmp_path) == []
+
+
+def test_task_with_missing_body_is_dead(redis_client):
+    job = DistributedJob(
+        'missing', lambda controller, item: None,
+        redis_pool=redis_client, payload_store=RedisPayloadStore(threshold=10)
+    )
+    job.distribute(['missing' * 10])
+    redis_client.delete(*redis_client.keys('missing.payload.*'))
+
+    assert job.callback(()) == 1
+    assert job.describe()['dead'] == 1
+    assert redis_client.zcard('missing.nack') == 0
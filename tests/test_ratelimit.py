@@ -0,0 +1,73 @@
+import time
+import pytest
+
+from workload.ratelimit import LUA_TAKE_TOKENS, RateLimit, get_rate_limit
+
+
+@pytest.fixture
+def take_tokens(redis_client):
+    func_take_tokens = redis_client.register_script(LUA_TAKE_TOKENS)
+    calls = []
+
+    def take_tokens(keys, args):
+        calls.append(args[2])
+        return func_take_tokens(keys=keys, args=args)
+
+    take_tokens.calls = calls
+    return take_tokens
+
+
+def test_bucket_grants_up_to_burst(redis_client, take_tokens):
+    assert take_tokens(keys=['bucket'], args=[1, 5, 3]) == [3, b'0']
+    assert take_tokens(keys=['bucket'], args=[1, 5, 3]) == [2, b'0']
+
+    granted, wait = take_tokens(keys=['bucket'], args=[1, 5, 3])
+    assert granted == 0
+    assert 0.9 < float(wait) <= 1
+    # full bucket is the same as no bucket, so the key expires
+    assert 0 < redis_client.pttl('bucket') <= 6000
+
+
+def test_tokens_are_taken_in_batches(take_tokens):
+    rate_limit = RateLimit(10, burst=10, batch=5)
+
+    assert [rate_limit.acquire(take_tokens, 'bucket') for _ in range(5)] == [1] * 5
+    assert take_tokens.calls == [5]
+    assert rate_limit.acquire(take_tokens, 'bucket', count=3) == 3
+    assert take_tokens.calls == [5, 5]
+
+
+def test_unspent_tokens_expire(take_tokens):
+    rate_limit = RateLimit(100, burst=100, batch=5)
+
+    assert rate_limit.acquire(take_tokens, 'bucket') == 1
+    # batch is worth 0.05 seconds of tokens
+    time.sleep(0.06)
+    assert rate_limit.acquire(take_tokens, 'bucket') == 1
+    assert take_tokens.calls == [5, 5]
+
+
+def test_take_does_not_wait(take_tokens):
+    rate_limit = RateLimit(1, burst=1, batch=1)
+    assert rate_limit.take(take_tokens, 'bucket') == (1, 0)
+
+    taken, wait = rate_limit.take(take_tokens, 'bucket')
+    assert taken == 0
+    assert 0.9 < wait <= 1
+
+
+def test_acquire_without_workload_does_not_wait(take_tokens):
+    rate_limit = RateLimit(1, burst=1, batch=1)
+    assert rate_limit.acquire(take_tokens, 'bucket') == 1
+
+    started = time.monotonic()
+    assert rate_limit.acquire(take_tokens, 'bucket', pending=lambda: False) == 0
+    assert time.monotonic() - started < 0.5
+
+
+def test_rate_limit_arguments():
+    assert get_rate_limit(None) is None
+    assert (get_rate_limit(5).rate, get_rate_limit(5).burst) == (5, 5)
+    assert (get_rate_limit((5, 20)).rate, get_rate_limit((5, 20)).burst) == (5, 20)
+    with pytest.raises(Exception):
+        RateLimit(0)
@@ -0,0 +1,91 @@
+import redis
+
+from collections import Counter
+from workload.utils import call_script, chunk_workload, describe_many, weighted_round_robin
+from workload.deferred_job import DeferredJob
+from workload.distributed_job import DistributedJob
+
+
+def test_weighted_round_robin_is_smooth():
+    assert list(weighted_round_robin([('a', 5), ('b', 1), ('c', 1)])) == ['a', 'a', 'b', 'a', 'c', 'a', 'a']
+    assert list(weighted_round_robin([('a', 2), ('b', 1)])) == ['a', 'b', 'a']
+
+
+def test_weighted_round_robin_follows_weights():
+    weights = [('a', 3), ('b', 7), ('c', 1)]
+    assert Counter(weighted_round_robin(weights)) == dict(weights)
+
+
+def test_weighted_round_robin_without_weights():
+    assert list(weighted_round_robin([('a', 1), ('b', 1), ('c', 1)])) == ['a', 'b', 'c']
+    assert list(weighted_round_robin([])) == []
+
+
+def test_chunk_workload_by_size():
+    assert list(chunk_workload(range(7), size=3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(chunk_workload([], size=3)) == []
+
+
+def test_chunk_workload_by_bytes():
+    workload = [b'aaaa', b'bbbb', b'cc', b'dddddddddd', b'e']
+    # chunk is closed once it reaches max bytes
+    assert list(chunk_workload(workload, size=100, max_bytes=8)) == [
+        [b'aaaa', b'bbbb'], [b'cc', b'dddddddddd'], [b'e'],
+    ]
+
+
+def test_chunk_workload_large_item():
+    workload = [b'a' * 20, b'b', b'c']
+    assert list(chunk_workload(workload, size=100, max_bytes=8)) == [[b'a' * 20], [b'b', b'c']]
+
+
+def test_chunk_workload_size_before_bytes():
+    workload = [b'a', b'b', b'c']
+    assert list(chunk_workload(workload, size=2, max_bytes=8)) == [[b'a', b'b'], [b'c']]
+
+
+def test_call_script_loads_script_once(redis_client, monkeypatch):
+    loaded = []
+    script = redis_client.register_script('return ARGV[1]')
+    script_load = redis_client.script_load
+    monkeypatch.setattr(redis_client, 'script_load', lambda body: loaded.append(body) or script_load(body))
+
+    for value in ['a', 'b']:
+        pipeline = redis_client.pipeline()
+        call_script(pipeline, script, keys=[], args=[value])
+        # no SCRIPT EXISTS is sent on execute
+        assert not pipeline.scripts
+        assert pipeline.execute() == [value.encode()]
+
+    assert len(loaded) == 1
+
+
+def test_describe_many_in_single_round_trip(redis_client, monkeypatch):
+    sharded = DistributedJob('sharded', lambda controller, item: None, redis_pool=redis_client, shards=2)
+    plain = DistributedJob('plain', lambda controller, item: None, redis_pool=redis_client)
+    deferred = DeferredJob('deferred', lambda workload: None, redis_pool=redis_client.connection_pool)
+    sharded.distribute(['item{}'.format(index) for index in range(10)])
+    redis_client.sadd('{sharded:1}.dead', 'dead')
+    redis_client.set('{sharded:0}.error', 2)
+    redis_client.set('{sharded:1}.error', 3)
+    plain.distribute(['a', 'b'])
+    deferred.defer(1)
+    deferred.defer(2, delay=60)
+
+    executed = []
+    execute = redis.client.Pipeline.execute
+
+    def count_execute(pipeline, *args):
+        executed.append(len(pipeline))
+        return execute(pipeline, *args)
+
+    monkeypatch.setattr(redis.client.Pipeline, 'execute', count_execute)
+    described = describe_many([sharded, plain, deferred])
+    assert len(executed) == 1
+
+    # sharded counters are summed up, every job gets its own slice of the results
+    assert [
+        (description['workload'], description['dead'], description['errors']) for description in described[:2]
+    ] == [(10, 1, 5), (2, 0, 0)]
+    assert (described[2]['queue'], described[2]['delayed']) == (1, 1)
+    assert [description['tech_name'] for description in described] == ['sharded', 'plain', 'deferred']
@@ -1,2 +1,3 @@
 from .distributed_job import distributed, DistributedPool
 from .deferred_job import deferred, DeferredPool
+from .utils import describe_many
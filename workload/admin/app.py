@@ -1,6 +1,9 @@
 import re
 import json
+import time
 import base64
+import logging
+import threading
 
 import falcon
 import redis
@@ -9,25 +12,128 @@ from collections import OrderedDict
 
 from workload.deferred_job import DeferredJob
 from workload.distributed_job import DistributedJob
+from workload.metrics import BUCKET_FIELDS
+from workload.utils import describe_many
 
 from .templates import render_cached_template, render_template
 
 
 LEADING_SPACES = re.compile(r'$s+?')
+STATUS_TTL = 1
+EVENTS_INTERVAL = 1
+EVENTS_KEEPALIVE = 15
+
+LOG = logging.getLogger('admin')
+
+METRICS_GAUGES = [
+    ('workload_task_throughput', 'Tasks processed per second', lambda status: status['throughput']),
+    (
+        'workload_queued_tasks', 'Tasks waiting to be processed',
+        lambda status: status['queue'] if status['type'] == 'deferred' else status['workload']
+    ),
+    ('workload_dead_tasks', 'Tasks which exhausted their attempts', lambda status: status['dead']),
+]
+
+
+class StatusCollector:
+    """
+    Collects status of all jobs in a single round trip per redis pool,
+    collected status is shared by concurrent requests for ttl seconds
+    """
+    def __init__(self, jobs, ttl=STATUS_TTL):
+        self.__jobs = jobs
+        self.__ttl = ttl
+        self.__lock = threading.Lock()
+        self.__status = None
+        self.__collected = 0
+
+    def collect(self):
+        with self.__lock:
+            if self.__status is None or time.time() - self.__collected >= self.__ttl:
+                names = list(self.__jobs)
+                statuses = describe_many(self.__jobs[name]['job'] for name in names)
+                self.__status = dict(zip(names, statuses))
+                self.__collected = time.time()
+            return self.__status
+
+
+class StatusBroadcaster:
+    """
+    Single collector loop per process shared by all connected browsers,
+    the loop runs only while somebody is subscribed
+    """
+    def __init__(self, collector, interval=EVENTS_INTERVAL):
+        self.__collector = collector
+        self.__interval = interval
+        self.__condition = threading.Condition()
+        self.__subscribers = 0
+        self.__running = False
+        self.__status = {}
+        self.__version = 0
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                if not self.__subscribers:
+                    self.__running = False
+                    return
+
+            try:
+                status = self.__collector.collect()
+            except Exception as e:
+                LOG.error('failed to collect jobs status, reason {}'.format(e))
+            else:
+                with self.__condition:
+                    self.__status = status
+                    self.__version += 1
+                    self.__condition.notify_all()
+
+            time.sleep(self.__interval)
+
+    def subscribe(self):
+        """
+        :return: generator of server-sent events, the first event holds status of all jobs,
+            the following ones hold status of changed jobs only
+        """
+        with self.__condition:
+            self.__subscribers += 1
+            if not self.__running:
+                self.__running = True
+                threading.Thread(target=self.__run, daemon=True).start()
+
+        sent = {}
+        version = 0
+        try:
+            while True:
+                with self.__condition:
+                    updated = self.__condition.wait_for(lambda: self.__version != version, timeout=EVENTS_KEEPALIVE)
+                    status, version = self.__status, self.__version
+
+                changed = {name: info for name, info in status.items() if sent.get(name) != info}
+                if changed:
+                    sent.update(changed)
+                    yield 'data: {}\n\n'.format(json.dumps(changed)).encode('utf-8')
+                elif not updated:
+                    # lets the server notice disconnected browsers
+                    yield b': keepalive\n\n'
+        finally:
+            with self.__condition:
+                self.__subscribers -= 1
 
 
 class IndexResource:
-    def __init__(self, title, url_prefix, jobs, show_status, debug):
+    def __init__(self, title, url_prefix, jobs, collector, show_status, debug):
         self.__title = title
         self.__url_prefix = url_prefix
         self.__show_status = show_status
         self.__jobs = jobs
+        self.__collector = collector
         self.__render_template = render_template if debug else render_cached_template
 
     def on_get(self, req, resp):
         resp.content_type = 'text/html'
         jobs = []
-        statuses = StatusResource.collect_jobs_status(self.__jobs)
+        statuses = self.__collector.collect()
         for name, info in self.__jobs.items():
             jobs.append({
                 'name': name,
@@ -73,18 +179,57 @@ class IndexResource:
 
 
 class StatusResource:
-    def __init__(self, jobs):
-        self.__jobs = jobs
+    def __init__(self, collector):
+        self.__collector = collector
 
     def on_get(self, req, resp):
         resp.content_type = 'application/json'
-        resp.body = json.dumps(self.collect_jobs_status(self.__jobs))
+        resp.body = json.dumps(self.__collector.collect())
 
-    @classmethod
-    def collect_jobs_status(cls, jobs):
-        return {
-            name: info['job'].describe() for name, info in jobs.items()
-        }
+
+class EventsResource:
+    def __init__(self, broadcaster):
+        self.__broadcaster = broadcaster
+
+    def on_get(self, req, resp):
+        resp.content_type = 'text/event-stream'
+        resp.set_header('Cache-Control', 'no-cache')
+        resp.stream = self.__broadcaster.subscribe()
+
+
+class MetricsResource:
+    """
+    Jobs statistics in Prometheus text format
+    """
+    def __init__(self, collector):
+        self.__collector = collector
+
+    def on_get(self, req, resp):
+        resp.content_type = 'text/plain; version=0.0.4'
+        resp.body = format_metrics(self.__collector.collect())
+
+
+def format_metrics(statuses):
+    lines = [
+        '# HELP workload_task_duration_seconds Task processing time',
+        '# TYPE workload_task_duration_seconds histogram',
+    ]
+    for name, status in statuses.items():
+        latency = status['latency']
+        cumulative = 0
+        for field, count in zip(BUCKET_FIELDS, latency['buckets']):
+            cumulative += count
+            lines.append('workload_task_duration_seconds_bucket{{job="{}",le="{}"}} {}'.format(name, field, cumulative))
+        lines.append('workload_task_duration_seconds_sum{{job="{}"}} {}'.format(name, latency['sum']))
+        lines.append('workload_task_duration_seconds_count{{job="{}"}} {}'.format(name, latency['count']))
+
+    for metric, description, value in METRICS_GAUGES:
+        lines.append('# HELP {} {}'.format(metric, description))
+        lines.append('# TYPE {} gauge'.format(metric))
+        for name, status in statuses.items():
+            lines.append('{}{{job="{}"}} {}'.format(metric, name, value(status)))
+
+    return '\n'.join(lines) + '\n'
 
 
 class TaskActionResource:
@@ -108,6 +253,8 @@ class TaskActionResource:
             start(job)
         elif action == 'stop':
             job.cancel()
+        elif action == 'replay':
+            job.replay_dead()
 
         resp.body = json.dumps({
             'status': 'ok',
@@ -180,7 +327,10 @@ def start_defer(job):
 START_DEFER = start_defer
 
 
-def create_admin_app(prefix, jobs, title='Workload Admin', credentials=None, debug=False, redis_pool=None):
+def create_admin_app(
+    prefix, jobs, title='Workload Admin', credentials=None, debug=False, redis_pool=None,
+    status_ttl=STATUS_TTL, events_interval=EVENTS_INTERVAL
+):
     """
     Create WSGI application to administrate workload jobs
     :param prefix: url prefix for all routes, for example '/' or '/admin'
@@ -190,6 +340,8 @@ def create_admin_app(prefix, jobs, title='Workload Admin', credentials=None, deb
     :param credentials: tuple of (user, pass) or None if no auth needed
     :param debug: turn of debug mode for template rendering
     :param redis_pool: redis pool to track redis server information
+    :param status_ttl: seconds collected jobs status is shared between requests
+    :param events_interval: seconds between status checks of the live status stream
     :return: WSGI app
     """
     tasks = OrderedDict()
@@ -218,11 +370,15 @@ def create_admin_app(prefix, jobs, title='Workload Admin', credentials=None, deb
         username, password = credentials
         middleware.append(AuthMiddleware(username=username, password=password))
 
+    collector = StatusCollector(tasks, ttl=status_ttl)
+
     app = falcon.API(middleware=middleware)
     app.req_options.auto_parse_form_urlencoded = True
-    app.add_route('{}'.format(prefix), IndexResource(title, prefix, tasks,
+    app.add_route('{}'.format(prefix), IndexResource(title, prefix, tasks, collector,
                                                      show_status=redis_pool is not None, debug=debug))
-    app.add_route('{}/status'.format(prefix), StatusResource(tasks))
+    app.add_route('{}/status'.format(prefix), StatusResource(collector))
+    app.add_route('{}/events'.format(prefix), EventsResource(StatusBroadcaster(collector, interval=events_interval)))
+    app.add_route('{}/metrics'.format(prefix), MetricsResource(collector))
     app.add_route('{}/actions'.format(prefix), TaskActionResource(tasks))
     if redis_pool:
         app.add_route('{}/rstatus'.format(prefix), RedisStatusResource(redis_pool))
@@ -0,0 +1,101 @@
+import threading
+
+from .hooks import Hooks
+from .utils import AUTOSCALE_INTERVAL
+
+
+class Autoscale(Hooks):
+    """
+    AIMD controller of amount of active worker threads, see DistributedJob.start_threaded.
+    Every interval the limit grows by one thread while there is queued workload
+    and is multiplied by decrease once error rate or average task latency exceed their targets.
+    Without queued workload the limit shrinks by one thread down to min_threads
+    :param min_threads: amount of threads active all the time
+    :param max_threads: amount of started threads
+    :param target_latency: seconds, average latency of job function call above it means
+        downstream services are overloaded. Latency is not considered if not set
+    :param max_error_rate: share of failed calls above which the limit is decreased
+    :param decrease: factor of multiplicative decrease
+    :param interval: seconds between scaling decisions
+    """
+    __slots__ = [
+        'min_threads',
+        'max_threads',
+        'interval',
+        'limit',
+        'decision',
+        '__target_latency',
+        '__max_error_rate',
+        '__decrease',
+        '__condition',
+        '__calls',
+        '__errors',
+        '__elapsed',
+    ]
+
+    def __init__(
+        self, min_threads=1, max_threads=10,
+        target_latency=None, max_error_rate=0.1, decrease=0.5, interval=AUTOSCALE_INTERVAL
+    ):
+        if not 0 < min_threads <= max_threads:
+            raise Exception('Threads bounds should satisfy 0 < min_threads <= max_threads')
+
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+        self.interval = interval
+        self.limit = min_threads
+        self.decision = None
+        self.__target_latency = target_latency
+        self.__max_error_rate = max_error_rate
+        self.__decrease = decrease
+        self.__condition = threading.Condition()
+        self.__calls = 0
+        self.__errors = 0
+        self.__elapsed = 0.0
+
+    def after_call(self, job_name, count, elapsed, error, state):
+        with self.__condition:
+            self.__calls += 1
+            self.__elapsed += elapsed
+            if error is not None:
+                self.__errors += 1
+
+    def is_active(self, index):
+        return index < self.limit
+
+    def wait_active(self, index, timeout):
+        """
+        Block parked thread until it becomes active
+        :return: True if thread is active
+        """
+        with self.__condition:
+            return self.__condition.wait_for(lambda: index < self.limit, timeout=timeout)
+
+    def update(self, backlog):
+        """
+        Make scaling decision based on calls finished since the last update
+        :param backlog: amount of queued tasks
+        :return: new limit of active threads
+        """
+        with self.__condition:
+            calls, errors, elapsed = self.__calls, self.__errors, self.__elapsed
+            self.__calls = self.__errors = 0
+            self.__elapsed = 0.0
+
+            error_rate = errors / calls if calls else 0
+            latency = elapsed / calls if calls else 0
+            if error_rate > self.__max_error_rate:
+                self.limit = max(self.min_threads, int(self.limit * self.__decrease))
+                self.decision = 'decrease, error rate {:.2f}'.format(error_rate)
+            elif self.__target_latency is not None and latency > self.__target_latency:
+                self.limit = max(self.min_threads, int(self.limit * self.__decrease))
+                self.decision = 'decrease, latency {:.3f}s'.format(latency)
+            elif backlog:
+                self.limit = min(self.max_threads, self.limit + 1)
+                self.decision = 'increase, backlog {}'.format(backlog)
+            else:
+                self.limit = max(self.min_threads, self.limit - 1)
+                self.decision = 'decrease, no backlog'
+
+            self.__condition.notify_all()
+            return self.limit
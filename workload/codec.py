@@ -0,0 +1,163 @@
+import json
+import zlib
+import pickle
+
+from abc import ABC, abstractmethod
+from .utils import COMPRESSION_THRESHOLD
+
+
+class Codec(ABC):
+    """
+    Converts task payloads and results to bytes stored in redis and back.
+    Encoding should be deterministic, distributed workload is deduplicated
+    and acked by the encoded value
+    """
+    __slots__ = []
+
+    @abstractmethod
+    def encode(self, value):
+        """
+        :return: bytes stored in redis
+        """
+
+    @abstractmethod
+    def decode(self, data):
+        """
+        :param data: bytes read from redis
+        """
+
+
+class RawCodec(Codec):
+    """
+    Bytes are stored as is, other values are stored as their string representation
+    """
+    __slots__ = []
+
+    def encode(self, value):
+        if isinstance(value, bytes):
+            return value
+        return str(value).encode('utf-8')
+
+    def decode(self, data):
+        return data
+
+
+class TextCodec(RawCodec):
+    __slots__ = []
+
+    def decode(self, data):
+        return data.decode('utf-8')
+
+
+class JsonCodec(Codec):
+    __slots__ = []
+
+    def encode(self, value):
+        return json.dumps(value).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class PickleCodec(Codec):
+    """
+    Arbitrary python objects, payloads should come from trusted sources only
+    """
+    __slots__ = []
+
+    def encode(self, value):
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+class MsgpackCodec(Codec):
+    """
+    Requires msgpack to be installed manually
+    """
+    __slots__ = [
+        '__msgpack',
+    ]
+
+    def __init__(self):
+        import msgpack
+        self.__msgpack = msgpack
+
+    def encode(self, value):
+        return self.__msgpack.packb(value, use_bin_type=True)
+
+    def decode(self, data):
+        return self.__msgpack.unpackb(data, raw=False)
+
+
+class CompressedCodec(Codec):
+    """
+    Compress encoded payloads longer than threshold bytes.
+    Every payload is prefixed with a byte telling if it was compressed
+    :param codec: codec or codec name to compress payloads of
+    :param method: zlib or lz4, lz4 requires lz4 to be installed manually
+    """
+    __slots__ = [
+        '__codec',
+        '__threshold',
+        '__compress',
+        '__decompress',
+        '__marker',
+    ]
+
+    PLAIN = b'\x00'
+    MARKERS = {
+        'zlib': b'\x01',
+        'lz4': b'\x02',
+    }
+
+    def __init__(self, codec, method='zlib', threshold=COMPRESSION_THRESHOLD):
+        if method not in self.MARKERS:
+            raise Exception('Unknown compression method {}'.format(method))
+
+        self.__codec = get_codec(codec)
+        self.__threshold = threshold
+        self.__marker = self.MARKERS[method]
+        if method == 'lz4':
+            import lz4.frame
+            self.__compress = lz4.frame.compress
+            self.__decompress = lz4.frame.decompress
+        else:
+            self.__compress = zlib.compress
+            self.__decompress = zlib.decompress
+
+    def encode(self, value):
+        data = self.__codec.encode(value)
+        if len(data) < self.__threshold:
+            return self.PLAIN + data
+        return self.__marker + self.__compress(data)
+
+    def decode(self, data):
+        marker, data = data[:1], data[1:]
+        if marker == self.PLAIN:
+            return self.__codec.decode(data)
+        if marker != self.__marker:
+            raise Exception('Payload is not compressed by the codec')
+        return self.__codec.decode(self.__decompress(data))
+
+
+CODECS = {
+    'raw': RawCodec,
+    'text': TextCodec,
+    'json': JsonCodec,
+    'pickle': PickleCodec,
+    'msgpack': MsgpackCodec,
+}
+
+
+def get_codec(codec):
+    """
+    :param codec: codec instance or name of the built-in codec
+    :return: codec instance
+    """
+    if isinstance(codec, Codec):
+        return codec
+    if codec not in CODECS:
+        raise Exception('Unknown codec {}'.format(codec))
+    return CODECS[codec]()
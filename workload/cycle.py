@@ -3,17 +3,57 @@ Usage:
 
   cycle([
     (cycle.at(hour=1), job1),
-    (cycle.interval(minute=5), job2),
+    (cycle.interval(minutes=5), job2),
   ])
 
+  # any number of processes, every run is fired at most once by one of them
+  cycle([...], redis_pool=REDIS_POOL)
+
 """
+import heapq
 import logging
+import redis
 
 from time import sleep
 from datetime import datetime, timedelta
 
+from .utils import MAX_RETRY_SLEEP, IDLE_TIMEOUT, REAP_CHUNK_SIZE, SCHEDULE_STALE_TIMEOUT, defer_many
+
 
 LOG = logging.getLogger('workload.cycle')
+EPOCH = datetime(1970, 1, 1)
+
+# claim due tasks known to the caller and move them to their next run on the grid of period,
+# tasks of other processes are left to them. Tasks overdue for longer than the stale timeout
+# are known to no running process and are removed. Redis time is used, so clocks of workers may drift
+LUA_CLAIM_DUE = """
+redis.replicate_commands()
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local claimed = {}
+local next = false
+for i = 3, #ARGV do
+    local score = tonumber(redis.call('ZSCORE', KEYS[1], ARGV[i]))
+    local period = tonumber(redis.call('HGET', KEYS[2], ARGV[i]))
+    if score and period then
+        if score <= now then
+            score = score + period * (math.floor((now - score) / period) + 1)
+            redis.call('ZADD', KEYS[1], score, ARGV[i])
+            table.insert(claimed, ARGV[i])
+        end
+        if not next or score < next then
+            next = score
+        end
+    end
+end
+
+local stale = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[1]), 'LIMIT', 0, ARGV[2])
+if #stale > 0 then
+    redis.call('ZREM', KEYS[1], unpack(stale))
+    redis.call('HDEL', KEYS[2], unpack(stale))
+end
+return {claimed, next and tostring(next - now)}
+"""
 
 
 class At:
@@ -28,13 +68,26 @@ class At:
         self.minute = minute
         self.second = second
 
+    @property
+    def key(self):
+        return 'at:{:02}:{:02}:{:02}'.format(self.hour, self.minute, self.second)
+
+    @property
+    def period(self):
+        return 24 * 60 * 60
+
     def schedule(self, prev, now):
-        next_ = now + timedelta(days=1)
-        next_.replace(
+        """
+        Next time of the day after now, days missed during a pause are skipped
+        """
+        next_ = now.replace(
             hour=self.hour,
             minute=self.minute,
-            second=self.minute
+            second=self.second,
+            microsecond=0
         )
+        if next_ <= now:
+            next_ += timedelta(days=1)
         return next_
 
 
@@ -46,53 +99,160 @@ class Interval:
     ]
 
     def __init__(self, hours=0, minutes=0, seconds=0):
+        if timedelta(hours=hours, minutes=minutes, seconds=seconds) <= timedelta(0):
+            raise Exception('Interval should be positive')
+
         self.hours = hours
         self.minutes = minutes
         self.seconds = seconds
 
+    @property
+    def key(self):
+        return 'interval:{:g}'.format(self.period)
+
+    @property
+    def period(self):
+        return timedelta(hours=self.hours, minutes=self.minutes, seconds=self.seconds).total_seconds()
+
     def schedule(self, prev, now):
-        next_ = prev + timedelta(
+        """
+        Next time on the grid of prev after now, so the schedule does not drift.
+        Runs missed during a pause are skipped
+        """
+        step = timedelta(
             hours=self.hours,
             minutes=self.minutes,
             seconds=self.seconds
         )
+        next_ = prev + step
+        if next_ <= now:
+            next_ += step * ((now - next_) // step + 1)
         return next_
 
 
 class Task:
     __slots__ = [
-        'at', 'when', 'job'
+        'at', 'when', 'job', 'order'
     ]
 
-    def __init__(self, at, when, job):
+    def __init__(self, at, when, job, order):
         self.at = at
         self.when = when
         self.job = job
+        self.order = order
+
+    def __lt__(self, other):
+        # tasks due at the same time are fired in the order they were passed
+        return (self.at, self.order) < (other.at, other.order)
+
+
+def fire_due(queue, now):
+    """
+    Defer all due tasks in a single batch and schedule their next runs.
+    A task due several times since the last call is deferred once
+    :param queue: heap of tasks
+    :return: seconds until the next task is due
+    """
+    due = []
+    while queue and queue[0].at <= now:
+        due.append(heapq.heappop(queue))
+
+    for task in due:
+        task.at = task.when.schedule(prev=task.at, now=now)
+        heapq.heappush(queue, task)
+
+    if due:
+        LOG.debug('deferring {} scheduled tasks'.format(len(due)))
+        defer_many(task.job for task in due)
+
+    return (queue[0].at - now).total_seconds()
 
 
-def cycle(sheduled_jobs):
+def distributed_cycle(sheduled_jobs, redis_pool, name):
+    """
+    Schedule is a sorted set of next run timestamps shared by all workers.
+    Due tasks are claimed and moved to their next run by a single script call,
+    so a run is fired at most once, it is lost if the worker dies right after the claim.
+    Task is identified by job name and schedule, the first started worker sets its first run.
+    Workers claim only tasks they know, so workers with different sets of tasks could run
+    side by side during a deploy
+    """
+    redis_client = redis.StrictRedis(connection_pool=redis_pool)
+    func_claim_due = redis_client.register_script(LUA_CLAIM_DUE)
+    key_schedule = '{}.schedule'.format(name)
+    key_periods = '{}.periods'.format(name)
+
+    jobs = {}
+    pipeline = redis_client.pipeline()
+    seconds, microseconds = redis_client.time()
+    now = EPOCH + timedelta(seconds=seconds, microseconds=microseconds)
+    for when, job in sheduled_jobs:
+        if not hasattr(job, 'defer') or not hasattr(job, 'name'):
+            raise RuntimeError('Job should have defer method and name')
+
+        task_id = '{}:{}'.format(job.name, when.key)
+        jobs.setdefault(task_id, []).append(job)
+        (
+            pipeline
+                .zadd(key_schedule, {task_id: (when.schedule(now, now) - EPOCH).total_seconds()}, nx=True)
+                .hset(key_periods, task_id, when.period)
+        )
+    pipeline.execute()
+
+    exception_tries = 0
+    while True:
+        try:
+            claimed, next_in = func_claim_due(
+                keys=[key_schedule, key_periods], args=[SCHEDULE_STALE_TIMEOUT, REAP_CHUNK_SIZE, *jobs]
+            )
+
+            due = []
+            for task_id in claimed:
+                due.extend(jobs[task_id.decode('utf-8')])
+
+            if due:
+                LOG.debug('{}: deferring {} scheduled tasks'.format(name, len(due)))
+                defer_many(due)
+        except Exception as e:
+            exception_tries += 1
+            LOG.error('{}: exception during scheduling loop. Increasing wait time. {}'.format(name, e))
+            sleep(min(2 ** exception_tries, MAX_RETRY_SLEEP))
+            continue
+
+        exception_tries = 0
+        # schedule could be changed by other workers, so the sleep is limited
+        timeout = IDLE_TIMEOUT if next_in is None else min(float(next_in), IDLE_TIMEOUT)
+        if timeout > 0:
+            sleep(timeout)
+
+
+def cycle(sheduled_jobs, redis_pool=None, name='workload.cycle'):
     """
     Start scheduled job worker. The worker will push deferred tasks to
-    redis queue
+    redis queue, it sleeps until the next task is due
+    :param redis_pool: keep schedule in redis, so any number of workers
+        could run the same schedule and every run is fired at most once
+    :param name: name of the schedule, used as prefix for redis keys
     """
+    if redis_pool is not None:
+        return distributed_cycle(sheduled_jobs, redis_pool, name)
+
     queue = []
     now = datetime.utcnow()
-    for when, job in sheduled_jobs:
+    for order, (when, job) in enumerate(sheduled_jobs):
         if not hasattr(job, 'defer'):
             raise RuntimeError('Job should have defer method')
 
-        queue.append(Task(at=when.schedule(now, now), when=when, job=job))
-
-    while True:
-        now = datetime.utcnow()
-        for task in queue:
-            if task.at > now:
-                continue
+        queue.append(Task(at=when.schedule(now, now), when=when, job=job, order=order))
 
-            task.job.defer()
-            task.at = task.when.schedule(prev=task.at, now=now)
+    if not queue:
+        return
+    heapq.heapify(queue)
 
-        sleep(0.001)
+    while True:
+        timeout = fire_due(queue, datetime.utcnow())
+        if timeout > 0:
+            sleep(timeout)
 
 
 cycle.at = At
@@ -1,32 +1,218 @@
-import json
+import os
 import time
+import uuid
+import socket
+import calendar
+import asyncio
 import logging
+import threading
 import redis
 
-from .utils import LOG_TRIM, MAX_RETRY_SLEEP, parse_int
+from datetime import datetime, timedelta
+from .codec import get_codec
+from .hooks import GuardedHooks
+from .metrics import TaskMetrics
+from .ratelimit import LUA_TAKE_TOKENS, get_rate_limit
+from .utils import (
+    MAX_RETRY_SLEEP,
+    IDLE_TIMEOUT,
+    MIN_WAIT_TIMEOUT,
+    RECLAIM_TIMEOUT,
+    REAP_CHUNK_SIZE,
+    PROMOTE_INTERVAL,
+    DEFAULT_RETRY_BACKOFF,
+    trim_log,
+    call_script,
+    weighted_round_robin,
+    create_async_redis,
+)
 
 
 LOG = logging.getLogger('workload.deferred')
 
 
+LUA_RECLAIM = """
+local n = 0
+while redis.call("RPOPLPUSH", KEYS[1], KEYS[2]) do
+    n = n + 1
+end
+redis.call("ZREM", KEYS[3], ARGV[1])
+return n
+"""
+
+# keys are pairs of delayed set and queue, so delayed tasks of all jobs are promoted in a single call.
+# Returns the most tasks moved from a single set and seconds until the earliest delayed task is due
+LUA_PROMOTE = """
+redis.replicate_commands()
+local now = redis.call("TIME")
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+
+local promoted = 0
+local next = false
+for i = 1, #KEYS, 2 do
+    local v = redis.call("ZRANGEBYSCORE", KEYS[i], "-inf", now, "LIMIT", 0, ARGV[1])
+    if #v > 0 then
+        redis.call("ZREM", KEYS[i], unpack(v))
+        redis.call("RPUSH", KEYS[i + 1], unpack(v))
+    end
+    promoted = math.max(promoted, #v)
+
+    local first = redis.call("ZRANGE", KEYS[i], 0, 0, "WITHSCORES")
+    if first[2] and (not next or tonumber(first[2]) < next) then
+        next = tonumber(first[2])
+    end
+end
+return {promoted, next and tostring(math.max(0, next - now))}
+"""
+
+# delay is relative to redis server time, so clocks of clients do not matter.
+# Workers sleep until the earliest delayed task is due, one of them is woken up if the new task is earlier
+LUA_DELAY = """
+redis.replicate_commands()
+local due = tonumber(ARGV[2])
+if ARGV[3] == "1" then
+    local now = redis.call("TIME")
+    due = due + tonumber(now[1]) + tonumber(now[2]) / 1000000
+end
+
+local first = redis.call("ZRANGE", KEYS[1], 0, 0, "WITHSCORES")
+redis.call("ZADD", KEYS[1], due, ARGV[1])
+if not first[2] or due < tonumber(first[2]) then
+    redis.call("RPUSH", KEYS[2], 1)
+    redis.call("LTRIM", KEYS[2], 0, 0)
+end
+"""
+
+LUA_REPLAY = """
+local n = 0
+local v = redis.call("LPOP", KEYS[1])
+while v do
+    redis.call("RPUSH", KEYS[2], v)
+    n = n + 1
+    v = redis.call("LPOP", KEYS[1])
+end
+return n
+"""
+
+
+def get_due_time(delay=None, at=None):
+    """
+    :param delay: seconds or timedelta
+    :param at: timestamp or datetime, naive datetime is considered UTC
+    :return: tuple of (timestamp or seconds, True if seconds are relative to redis server time)
+        or None if task is due immediately
+    """
+    if delay is not None and at is not None:
+        raise Exception('Either delay or at should be set')
+
+    if isinstance(delay, timedelta):
+        delay = delay.total_seconds()
+    if isinstance(at, datetime):
+        at = calendar.timegm(at.utctimetuple()) + at.microsecond / 1e6
+
+    if delay is not None:
+        return delay, True
+    if at is not None:
+        return at, False
+    return None
+
+
+def get_promote_at(promoted, next_in):
+    """
+    Get time of the next promotion, the earliest delayed task is promoted right when it is due.
+    Workers are notified about earlier tasks delayed by other clients in the meantime,
+    the delayed set is checked after PROMOTE_INTERVAL at the latest
+    :param promoted: most tasks moved from a single delayed set, full chunk means more tasks are due
+    :param next_in: seconds until the earliest delayed task is due, None if there is none
+    """
+    now = time.time()
+    if promoted >= REAP_CHUNK_SIZE:
+        return now
+    if next_in is None:
+        return now + PROMOTE_INTERVAL
+    return now + min(float(next_in), PROMOTE_INTERVAL)
+
+
+def get_wait_timeout(promote_at):
+    """
+    Seconds to block waiting for a task, so the worker wakes up for the next promotion
+    """
+    # zero timeout would block forever
+    return min(max(promote_at - time.time(), MIN_WAIT_TIMEOUT), IDLE_TIMEOUT)
+
+
+def pack_task(payload, attempts):
+    """
+    Wrap retried task payload, unique token keeps equal payloads apart in delayed set
+    """
+    return '#{}:{}:'.format(attempts, uuid.uuid4().hex).encode('utf-8') + payload
+
+
+def unpack_task(task):
+    """
+    :return: tuple of (encoded payload, amount of failed attempts)
+    """
+    if not task.startswith(b'#'):
+        return task, 0
+
+    attempts, _, payload = task[1:].split(b':', 2)
+    return payload, int(attempts)
+
+
 class DeferredJob:
     __slots__ = [
         'logger',
         '__redis_client',
         '__name',
         '__callback',
+        '__codec',
+        '__max_attempts',
+        '__retry_backoff',
+        '__metrics',
+        '__hooks',
+        '__rate_limit',
         '__run',
 
         '__key_queue',
+        '__key_consumers',
+        '__key_delayed',
+        '__key_notify',
+        '__key_dead',
+        '__key_rate_limit',
+        '__func_reclaim',
+        '__func_promote',
+        '__func_delay',
+        '__func_replay',
+        '__func_take_tokens',
     ]
 
-    def __init__(self, name, callback, redis_pool):
+    def __init__(
+        self, name, callback, redis_pool,
+        max_attempts=None, retry_backoff=DEFAULT_RETRY_BACKOFF, codec='json', hooks=None, rate_limit=None
+    ):
         self.__name = name
         self.__callback = callback
+        self.__codec = get_codec(codec)
         self.__redis_client = redis.StrictRedis(connection_pool=redis_pool)
+        self.__max_attempts = max_attempts
+        self.__retry_backoff = retry_backoff
+        self.__metrics = TaskMetrics(name)
+        self.__hooks = None if hooks is None else GuardedHooks(hooks)
+        self.__rate_limit = get_rate_limit(rate_limit)
         self.__run = True
 
         self.__key_queue = '{}.queue'.format(self.__name)
+        self.__key_consumers = '{}.consumers'.format(self.__name)
+        self.__key_delayed = '{}.delayed'.format(self.__name)
+        self.__key_notify = '{}.delayed.notify'.format(self.__name)
+        self.__key_dead = '{}.dead'.format(self.__name)
+        self.__key_rate_limit = '{}.rate_limit'.format(self.__name)
+
+        self.__func_reclaim = self.__redis_client.register_script(LUA_RECLAIM)
+        self.__func_promote = self.__redis_client.register_script(LUA_PROMOTE)
+        self.__func_delay = self.__redis_client.register_script(LUA_DELAY)
+        self.__func_replay = self.__redis_client.register_script(LUA_REPLAY)
+        self.__func_take_tokens = self.__redis_client.register_script(LUA_TAKE_TOKENS)
 
     @property
     def name(self):
@@ -36,34 +222,147 @@ class DeferredJob:
     def action(self):
         return self.__callback
 
+    @property
+    def redis_client(self):
+        return self.__redis_client
+
+    @property
+    def queue(self):
+        return self.__key_queue
+
+    @property
+    def delayed(self):
+        return self.__key_delayed
+
+    @property
+    def notify(self):
+        return self.__key_notify
+
     def describe(self):
         """
         Get job statistics
         """
+        return self._parse_description(self._describe_commands(self.__redis_client.pipeline()).execute())
+
+    def _describe_commands(self, pipeline):
+        """
+        Add commands collecting job statistics to the pipeline, see describe_many
+        """
+        (
+            pipeline
+                .llen(self.__key_queue)
+                .zcard(self.__key_delayed)
+                .llen(self.__key_dead)
+        )
+        return self.__metrics.describe_commands(pipeline)
+
+    def _parse_description(self, results):
+        """
+        :param results: results of commands added by _describe_commands
+        """
+        queue, delayed, dead = results[:3]
         return {
-            'queue': parse_int(self.__redis_client.llen(self.__key_queue)),
+            'queue': queue,
+            'delayed': delayed,
+            'dead': dead,
             'type': 'deferred',
             'tech_name': self.__name,
+            **self.__metrics.parse_description(results[3:]),
         }
 
-    def defer(self, workload=None):
-        self.__redis_client.rpush(self.__key_queue, json.dumps(workload))
+    def defer(self, workload=None, delay=None, at=None):
+        """
+        Queue a task, delayed task is kept in delayed set and queued by workers once it is due
+        :param delay: seconds or timedelta to wait before the task is queued
+        :param at: timestamp or datetime to queue the task at, naive datetime is considered UTC
+        """
+        self._defer_commands(self.__redis_client.pipeline(transaction=False), workload, delay, at).execute()
+
+    def _defer_commands(self, pipeline, workload=None, delay=None, at=None):
+        """
+        Add command deferring a task to the pipeline, see defer_many
+        """
+        payload = self.__codec.encode(workload)
+        due_time = get_due_time(delay, at)
+        if due_time is not None:
+            # unique token keeps equal payloads apart in delayed set
+            return self.__delay(pipeline, pack_task(payload, 0), *due_time)
+
+        if payload.startswith(b'#'):
+            # keep payload apart from retried tasks
+            payload = pack_task(payload, 0)
+        return pipeline.rpush(self.__key_queue, payload)
+
+    def __delay(self, pipeline, task, due_time, relative):
+        """
+        Add command putting the task to delayed set to the pipeline, see LUA_DELAY
+        """
+        return call_script(
+            pipeline, self.__func_delay,
+            keys=[self.__key_delayed, self.__key_notify], args=[task, due_time, int(relative)]
+        )
 
     def cancel(self):
-        self.__redis_client.delete(self.__key_queue)
+        self.__redis_client.delete(self.__key_queue, self.__key_delayed, self.__key_notify)
+
+    def promote(self):
+        """
+        Move delayed tasks which are due to the queue
+        :return: amount of moved tasks
+        """
+        promoted = 0
+        while True:
+            count, _ = self.__func_promote(keys=[self.__key_delayed, self.__key_queue], args=[REAP_CHUNK_SIZE])
+            promoted += count
+            if count < REAP_CHUNK_SIZE:
+                return promoted
+
+    def promote_due(self):
+        """
+        Move delayed tasks which are due to the queue, single chunk only
+        :return: time of the next promotion, see get_promote_at
+        """
+        return get_promote_at(*self.__func_promote(
+            keys=[self.__key_delayed, self.__key_queue], args=[REAP_CHUNK_SIZE]
+        ))
+
+    def replay_dead(self):
+        """
+        Return tasks which exhausted their attempts back to the queue
+        :return: amount of returned tasks
+        """
+        return self.__func_replay(keys=[self.__key_dead, self.__key_queue])
+
+    def start_processing(self, reliable=False, worker_id=None):
+        """
+        Process queued tasks until stopped
+        :param reliable: keep every task in the worker processing list until it is processed,
+            tasks left by dead workers are returned to the queue on startup
+        :param worker_id: unique worker name for reliable mode, a stable name allows
+            restarted worker to reclaim its own tasks immediately
+        """
+        worker_id = self.__get_worker_id(reliable, worker_id)
+        key_processing = None if worker_id is None else self.__get_key_processing(worker_id)
 
-    def start_processing(self):
         self.__run = True
         exception_tries = 0
+        heartbeat = 0
+        promote_at = 0
 
         while self.__run:
             try:
-                result = self.process_one()
-                if result is None:
-                    time.sleep(1)
-                    continue
+                if worker_id is not None and time.time() - heartbeat >= IDLE_TIMEOUT:
+                    heartbeat = time.time()
+                    self.__redis_client.zadd(self.__key_consumers, {worker_id: heartbeat})
+
+                if time.time() >= promote_at:
+                    promote_at = self.promote_due()
 
-                time.sleep(0.001)
+                task, notified = self.__claim(get_wait_timeout(promote_at), key_processing, self.__key_notify)
+                if notified:
+                    # earlier task was delayed
+                    promote_at = 0
+                self.__process_claimed(task, key_processing)
             except Exception as e:
                 exception_tries += 1
                 LOG.error('{}: exception during processing loop. Increasing wait time. {}'.format(
@@ -73,38 +372,400 @@ class DeferredJob:
             else:
                 exception_tries = 0
 
-    def process_one(self):
+    def start_async(self, concurrency=100, reliable=False, worker_id=None):
+        """
+        Process queued tasks with asyncio until stopped, job function should be a coroutine function
+        :param concurrency: amount of tasks in flight
+        :param reliable: see start_processing
+        :param worker_id: see start_processing
+        """
+        asyncio.run(self.process_async(concurrency=concurrency, reliable=reliable, worker_id=worker_id))
+
+    async def process_async(self, concurrency=100, reliable=False, worker_id=None):
+        """
+        Coroutine version of start_async to run inside of existing event loop
+        """
+        if not asyncio.iscoroutinefunction(self.__callback):
+            raise Exception('Job {} function should be a coroutine function'.format(self.__name))
+
+        worker_id = self.__get_worker_id(reliable, worker_id)
+        key_processing = None if worker_id is None else self.__get_key_processing(worker_id)
+
+        redis_client = create_async_redis(self.__redis_client.connection_pool)
+        func_promote = redis_client.register_script(LUA_PROMOTE)
+        func_take_tokens = redis_client.register_script(LUA_TAKE_TOKENS)
+        slots = asyncio.Semaphore(concurrency)
+        tasks = set()
+
+        async def process(task):
+            try:
+                await self.__process_async(redis_client, task)
+            except Exception as e:
+                LOG.error('{}: failed to process, reason {}'.format(self.__name, e))
+
+            try:
+                acked = time.monotonic()
+                await self.__ack_commands(redis_client.pipeline(), task, key_processing).execute()
+                self.__acked(acked)
+            finally:
+                slots.release()
+
+        self.__run = True
+        exception_tries = 0
+        heartbeat = 0
+        promote_at = 0
+
+        try:
+            while self.__run:
+                try:
+                    if worker_id is not None and time.time() - heartbeat >= IDLE_TIMEOUT:
+                        heartbeat = time.time()
+                        await redis_client.zadd(self.__key_consumers, {worker_id: heartbeat})
+
+                    if time.time() >= promote_at:
+                        promote_at = get_promote_at(*await func_promote(
+                            keys=[self.__key_delayed, self.__key_queue], args=[REAP_CHUNK_SIZE]
+                        ))
+
+                    await slots.acquire()
+                    try:
+                        task, notified = await self.__claim_async(
+                            redis_client, func_take_tokens, get_wait_timeout(promote_at), key_processing,
+                            self.__key_notify
+                        )
+                    except Exception:
+                        slots.release()
+                        raise
+
+                    if notified:
+                        # earlier task was delayed
+                        promote_at = 0
+
+                    if task is None:
+                        slots.release()
+                        continue
+
+                    task = asyncio.ensure_future(process(task))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                except Exception as e:
+                    exception_tries += 1
+                    LOG.error('{}: exception during processing loop. Increasing wait time. {}'.format(
+                        self.__name, e
+                    ))
+                    await asyncio.sleep(min(2 ** exception_tries, MAX_RETRY_SLEEP))
+                else:
+                    exception_tries = 0
+
+            await asyncio.gather(*tasks)
+        finally:
+            await redis_client.connection_pool.disconnect()
+
+    def __get_worker_id(self, reliable, worker_id):
+        """
+        Get worker name for reliable mode and reclaim tasks left by the previous runs
+        :return: worker name or None if mode is not reliable
+        """
+        if not reliable:
+            return None
+
+        worker_id = worker_id or '{}:{}:{}'.format(socket.gethostname(), os.getpid(), threading.get_ident())
+        self.reclaim(worker_id)
+        self.reclaim()
+        return worker_id
+
+    def reclaim(self, worker_id=None, timeout=RECLAIM_TIMEOUT):
+        """
+        Return tasks left in processing lists back to the queue
+        :param worker_id: worker to reclaim tasks from, if omitted all workers
+            not seen for longer than timeout seconds are reclaimed
+        :return: amount of tasks returned to the queue
+        """
+        if worker_id is None:
+            worker_ids = self.__redis_client.zrangebyscore(self.__key_consumers, '-inf', time.time() - timeout)
+            worker_ids = [worker_id.decode('utf-8') for worker_id in worker_ids]
+        else:
+            worker_ids = [worker_id]
+
+        reclaimed = 0
+        for worker_id in worker_ids:
+            count = self.__func_reclaim(
+                keys=[self.__get_key_processing(worker_id), self.__key_queue, self.__key_consumers],
+                args=[worker_id]
+            )
+            if count:
+                LOG.warning('{}: reclaimed {} tasks of worker {}'.format(self.__name, count, worker_id))
+            reclaimed += count
+
+        return reclaimed
+
+    def process_one(self, timeout=None, worker_id=None):
         """
         Process one task from top of the queue.
+        :param timeout: seconds to wait for a task, None to return immediately
+        :param worker_id: if set task is kept in the worker processing list until processed
         :raises: Redis errors, decoding errors
         :return: None if there is no tasks queued, True if task successfully processed, False otherwise
         """
-        task = self.__redis_client.lpop(self.__key_queue)
+        key_processing = None if worker_id is None else self.__get_key_processing(worker_id)
+
+        task, _ = self.__claim(timeout, key_processing)
+        return self.__process_claimed(task, key_processing)
+
+    def __claim(self, timeout, key_processing, key_notify=None):
+        """
+        Take rate limit token and pop a task. Token is taken before pop, so popped task does not wait for it
+        and is not left in the processing list if taking the token fails
+        :return: see __pop
+        """
+        if self.__rate_limit is not None:
+            self.__rate_limit.acquire(self.__func_take_tokens, self.__key_rate_limit)
+
+        claimed = time.monotonic()
+        try:
+            results = self.__pop_commands(
+                self.__redis_client.pipeline(transaction=False), timeout, key_processing, key_notify
+            ).execute()
+        except Exception:
+            self.__release_token()
+            raise
+
+        task, notified = self.__popped(results, claimed)
+        if task is None:
+            self.__metrics.flush(self.__redis_client.pipeline(), force=True).execute()
+        return task, notified
+
+    async def __claim_async(self, redis_client, func_take_tokens, timeout, key_processing, key_notify=None):
+        if self.__rate_limit is not None:
+            await self.__rate_limit.acquire_async(func_take_tokens, self.__key_rate_limit)
+
+        claimed = time.monotonic()
+        try:
+            results = await self.__pop_commands(
+                redis_client.pipeline(transaction=False), timeout, key_processing, key_notify
+            ).execute()
+        except Exception:
+            self.__release_token()
+            raise
+
+        task, notified = self.__popped(results, claimed)
+        if task is None:
+            await self.__metrics.flush(redis_client.pipeline(), force=True).execute()
+        return task, notified
+
+    def __process_claimed(self, task, key_processing):
+        """
+        Process and ack claimed task, see process_one
+        """
         if task is None:
             return None
 
-        task = task.decode('utf-8')
-        task_log = task[:LOG_TRIM]
+        try:
+            result = self.__process(task)
+        except Exception:
+            self.__ack(task, key_processing)
+            raise
+
+        self.__ack(task, key_processing)
+        return result
+
+    def __get_key_processing(self, worker_id):
+        return '{}.processing.{}'.format(self.__name, worker_id)
+
+    def __pop_commands(self, pipeline, timeout, key_processing, key_notify=None):
+        """
+        Add commands popping a task to the pipeline, see __popped
+        :param timeout: seconds to block waiting for a task, None to return immediately
+        :param key_processing: if set the task is moved to the worker processing list
+        :param key_notify: if set blocking pop is interrupted by notification about earlier delayed task
+        """
+        if timeout is None:
+            if key_processing is None:
+                return pipeline.lpop(self.__key_queue)
+            return pipeline.lmove(self.__key_queue, key_processing, 'LEFT', 'LEFT')
+
+        if key_processing is None:
+            keys = [self.__key_queue] if key_notify is None else [key_notify, self.__key_queue]
+            return pipeline.blpop(keys, timeout=timeout)
+
+        pipeline.blmove(self.__key_queue, key_processing, timeout, 'LEFT', 'LEFT')
+        if key_notify is not None:
+            # blocking move waits on the queue only, notification is checked once the wait is over
+            pipeline.lpop(key_notify)
+        return pipeline
+
+    def __popped(self, results, claimed):
+        """
+        Keep the token for the next pop if there is no task, otherwise report the claim
+        :param results: results of commands added by __pop_commands
+        :param claimed: monotonic time the pop was started at
+        :return: tuple of (task or None, True if notified about earlier delayed task)
+        """
+        task, notified = results[0], len(results) > 1 and results[1] is not None
+        if isinstance(task, (list, tuple)):
+            # blocking pop of several lists results in the list and the task
+            key, task = task
+            if key != self.__key_queue.encode('utf-8'):
+                task, notified = None, True
+
+        if task is None:
+            self.__release_token()
+        elif self.__hooks is not None:
+            # includes time spent blocked on empty queue
+            self.__hooks.on_claim(self.__name, 1, time.monotonic() - claimed)
+        return task, notified
+
+    def __ack(self, task, key_processing):
+        acked = time.monotonic()
+        self.__ack_commands(self.__redis_client.pipeline(), task, key_processing).execute()
+        self.__acked(acked)
+
+    def __ack_commands(self, pipeline, task, key_processing):
+        """
+        Add commands acking processed task to the pipeline
+        """
+        # timings are flushed along with the ack once flush interval passed
+        self.__metrics.flush(pipeline)
+        if key_processing is not None:
+            pipeline.lrem(key_processing, 1, task)
+        return pipeline
+
+    def __acked(self, acked):
+        """
+        :param acked: monotonic time the ack was started at
+        """
+        if self.__hooks is not None:
+            self.__hooks.on_ack(self.__name, 1, time.monotonic() - acked)
+
+    def _take_token(self):
+        """
+        Take rate limit token for the next pop without waiting, see DeferredPool.start_all
+        :return: seconds until the token is available, 0 if it is taken
+        """
+        if self.__rate_limit is None:
+            return 0
+        taken, wait = self.__rate_limit.take(self.__func_take_tokens, self.__key_rate_limit)
+        return 0 if taken else wait
+
+    def _process_popped(self, task, claimed):
+        """
+        Process task popped with the rate limit token taken by _take_token, see DeferredPool.start_all
+        :param claimed: monotonic time the pop was started at
+        """
+        if self.__hooks is not None:
+            self.__hooks.on_claim(self.__name, 1, time.monotonic() - claimed)
+        return self.__process_claimed(task, None)
+
+    def __process(self, task):
+        """
+        Process task claimed along with rate limit token, failed task is retried
+        or moved to dead list if job has max attempts
+        :return: True if task successfully processed, False otherwise
+        """
+        payload, attempts, state, started = self.__call_started(task)
+        error = None
+        try:
+            self.__callback(self.__codec.decode(payload))
+        except Exception as e:
+            error = e
+
+        pipeline = self.__call_finished(self.__redis_client, payload, attempts, started, state, error)
+        if pipeline is not None:
+            pipeline.execute()
+        return error is None
 
+    async def __process_async(self, redis_client, task):
+        payload, attempts, state, started = self.__call_started(task)
+        error = None
         try:
-            LOG.info('{}: started processing {}'.format(self.__name, task_log))
-            self.__callback(json.loads(task))
-            LOG.info('{}: finished processing {}'.format(self.__name, task_log))
+            await self.__callback(self.__codec.decode(payload))
         except Exception as e:
-            LOG.error('{}: failed to process {}, reason {}'.format(
-                self.__name, task_log, e
-            ))
-            return False
+            error = e
 
-        return True
+        pipeline = self.__call_finished(redis_client, payload, attempts, started, state, error)
+        if pipeline is not None:
+            await pipeline.execute()
+        return error is None
+
+    def __call_started(self, task):
+        """
+        Unpack the task and record the call start
+        :return: encoded payload, amount of failed attempts, value returned by before_call hook
+            and monotonic start time
+        """
+        payload, attempts = unpack_task(task)
+        LOG.info('{}: started processing {}'.format(self.__name, trim_log(payload)))
+        state = self.__hooks and self.__hooks.before_call(self.__name, 1)
+        return payload, attempts, state, time.monotonic()
+
+    def __call_finished(self, redis_client, payload, attempts, started, state, error=None):
+        """
+        Record timing of finished job function call
+        :param redis_client: client of the engine, sync or asyncio
+        :param state: value returned by before_call hook
+        :param error: exception raised by job function
+        :return: pipeline scheduling retry of the failed task, None if there is nothing to write
+        """
+        elapsed = time.monotonic() - started
+        self.__metrics.record(elapsed)
+        if self.__hooks is not None:
+            self.__hooks.after_call(self.__name, 1, elapsed, error, state)
+
+        if error is None:
+            LOG.info('{}: finished processing {}'.format(self.__name, trim_log(payload)))
+            return None
+
+        LOG.error('{}: failed to process {}, reason {}'.format(self.__name, trim_log(payload), error))
+        if self.__max_attempts is None:
+            return None
+        return self.__fail(redis_client.pipeline(), payload, attempts)
+
+    def __release_token(self):
+        """
+        Keep token taken for a task which was not popped for the next pop
+        """
+        if self.__rate_limit is not None:
+            self.__rate_limit.release(1)
+
+    def __fail(self, pipeline, payload, attempts):
+        """
+        Add commands to schedule retry of the failed task with exponential backoff
+        or move it to dead list if attempts are exhausted to the pipeline
+        """
+        attempts += 1
+        if attempts >= self.__max_attempts:
+            LOG.warning('{}: task {} exhausted {} attempts'.format(self.__name, trim_log(payload), attempts))
+            return pipeline.rpush(self.__key_dead, payload)
+
+        delay = min(self.__retry_backoff * 2 ** (attempts - 1), MAX_RETRY_SLEEP)
+        return self.__delay(pipeline, pack_task(payload, attempts), delay, True)
 
     def stop_processing(self):
         self.__run = False
 
 
-def deferred(name, redis_pool):
+def deferred(
+    name, redis_pool,
+    max_attempts=None, retry_backoff=DEFAULT_RETRY_BACKOFF, codec='json', hooks=None, rate_limit=None
+):
+    """
+    Make deferred job out of function
+    :param name: job name, used as prefix for redis keys
+    :param redis_pool: redis connection pool
+    :param max_attempts: if set failed task is retried with exponential backoff and moved to dead list
+        after max_attempts failures, otherwise failed task is dropped
+    :param retry_backoff: delay in seconds before the first retry, doubled for every next attempt
+    :param codec: codec or codec name task payloads are encoded with, see workload.codec
+    :param hooks: instrumentation hooks invoked around claim, job function call and ack, see workload.hooks
+    :param rate_limit: tasks per second, (tasks per second, burst) or workload.ratelimit.RateLimit.
+        The limit is shared by all workers of the job
+    """
     def decorator(func):
-        return DeferredJob(name, func, redis_pool=redis_pool)
+        return DeferredJob(
+            name, func, redis_pool=redis_pool,
+            max_attempts=max_attempts, retry_backoff=retry_backoff, codec=codec, hooks=hooks,
+            rate_limit=rate_limit
+        )
     return decorator
 
 
@@ -121,13 +782,77 @@ class DeferredPool:
     def start(self, task_name):
         self.__tasks[task_name].start_processing()
 
-    def start_all(self):
+    def start_all(self, weights=None):
+        """
+        Process tasks of all jobs with a single blocking pop across all queues.
+        All jobs should use the same redis server. Rate limit token is taken before the pop,
+        queues of jobs waiting for a token are left out of the pop, so they do not hold up the others
+        :param weights: optional dict of job name to positive integer weight,
+            queues are checked first in proportion to their weights (round robin by default),
+            so a busy queue can't starve the others
+        """
+        weights = weights or {}
+        schedule = list(weighted_round_robin([
+            (task_name, weights.get(task_name, 1)) for task_name in self.__tasks
+        ]))
+
+        orders = []
+        for index in range(len(schedule)):
+            order = []
+            for task_name in schedule[index:] + schedule[:index]:
+                if task_name not in order:
+                    order.append(task_name)
+            orders.append([self.__tasks[task_name] for task_name in order])
+
+        tasks = {task.queue.encode('utf-8'): task for task in self.__tasks.values()}
+        redis_client = next(iter(self.__tasks.values())).redis_client
+        # delayed tasks of all jobs are promoted in a single call
+        func_promote = redis_client.register_script(LUA_PROMOTE)
+        keys_promote = [key for task in self.__tasks.values() for key in (task.delayed, task.queue)]
+        keys_notify = [task.notify for task in self.__tasks.values()]
+
+        exception_tries = 0
+        promote_at = 0
+        # jobs holding the rate limit token for their next task and jobs waiting for it
+        tokens = set()
+        throttled = {}
+        index = 0
         while True:
-            for task_name, task in self.__tasks.items():
-                try:
-                    task.process_one()
-                except Exception as e:
-                    LOG.error('{}: failed to process, reason {}'.format(task_name, e))
+            order = orders[index]
+            index = (index + 1) % len(orders)
 
-            time.sleep(0.001)
+            try:
+                if time.time() >= promote_at:
+                    promote_at = get_promote_at(*func_promote(keys=keys_promote, args=[REAP_CHUNK_SIZE]))
+
+                keys = []
+                for task in order:
+                    if task.name not in tokens:
+                        if throttled.get(task.name, 0) > time.time():
+                            continue
+                        wait = task._take_token()
+                        if wait:
+                            throttled[task.name] = time.time() + wait
+                            continue
+                        tokens.add(task.name)
+                    keys.append(task.queue)
+
+                claimed = time.monotonic()
+                wake_at = min([promote_at, *(throttled[task.name] for task in order if task.queue not in keys)])
+                result = redis_client.blpop(keys_notify + keys, timeout=get_wait_timeout(wake_at))
+                if result is None:
+                    continue
 
+                key, task = result
+                if key not in tasks:
+                    # earlier task was delayed
+                    promote_at = 0
+                    continue
+                tokens.discard(tasks[key].name)
+                tasks[key]._process_popped(task, claimed)
+            except Exception as e:
+                exception_tries += 1
+                LOG.error('failed to process, reason {}. Increasing wait time'.format(e))
+                time.sleep(min(2 ** exception_tries, MAX_RETRY_SLEEP))
+            else:
+                exception_tries = 0
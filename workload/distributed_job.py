@@ -1,70 +1,395 @@
+import os
+import json
 import time
+import random
+import socket
+import asyncio
 import logging
-import redis
+import threading
+import multiprocessing
 
+from multiprocessing.connection import wait
 from multiprocessing.pool import ThreadPool
+from .codec import get_codec
+from .hooks import ChainHooks, GuardedHooks
+from .metrics import TaskMetrics
+from .payload import LUA_RELEASE
+from .ratelimit import LUA_TAKE_TOKENS, get_rate_limit
 from .utils import (
-    LOG_TRIM,
     MAX_RETRY_SLEEP,
     DEFAULT_CHUNK_SIZE,
+    DEFAULT_CHUNK_BYTES,
+    DEFAULT_WINDOW,
+    DEFAULT_LEASE_TIMEOUT,
+    DEFAULT_RETRY_BACKOFF,
+    REAP_CHUNK_SIZE,
+    IDLE_TIMEOUT,
+    WAIT_POLL_INTERVAL,
+    AUTOSCALE_TTL,
     parse_int,
+    trim_log,
     chunk_workload,
+    group_by_shard,
+    shard_of,
+    call_script,
+    get_redis_client,
+    is_cluster,
+    create_async_redis,
 )
 
 
-LUA_SPOPMOVE = """
+LUA_SPOPMOVE_MANY = """
 redis.replicate_commands()
-local v = redis.call("SPOP", KEYS[1])
-if v then
-    redis.call("SADD", KEYS[2], v)
+local v = redis.call("SPOP", KEYS[1], ARGV[1])
+if #v > 0 then
+    local deadline = redis.call("TIME")[1] + ARGV[2]
+    local lease = {}
+    for i, item in ipairs(v) do
+        lease[2 * i - 1] = deadline
+        lease[2 * i] = item
+    end
+    redis.call("ZADD", KEYS[2], unpack(lease))
 end
 return v
 """
 
-LUA_SCARD2 = """
-local v1 = redis.call("SCARD", KEYS[1])
-local v2 = redis.call("SCARD", KEYS[2])
-return {v1, v2}
+LUA_EXTEND = """
+redis.replicate_commands()
+local deadline = redis.call("TIME")[1] + ARGV[1]
+local lease = {}
+for i = 2, #ARGV do
+    lease[2 * i - 3] = deadline
+    lease[2 * i - 2] = ARGV[i]
+end
+return redis.call("ZADD", KEYS[1], "XX", "CH", unpack(lease))
+"""
+
+LUA_REAP = """
+redis.replicate_commands()
+local now = redis.call("TIME")[1]
+local moved = {}
+for i = 2, 3 do
+    local v = redis.call("ZRANGEBYSCORE", KEYS[i], "-inf", now, "LIMIT", 0, ARGV[1])
+    if #v > 0 then
+        redis.call("ZREM", KEYS[i], unpack(v))
+        redis.call("SADD", KEYS[1], unpack(v))
+    end
+    moved[i - 1] = #v
+end
+return {moved[1], moved[2], redis.call("SCARD", KEYS[1])}
 """
 
+LUA_FAIL = """
+redis.replicate_commands()
+local now = redis.call("TIME")[1]
+for i = 4, #ARGV do
+    local item = ARGV[i]
+    local attempts = redis.call("HINCRBY", KEYS[3], item, 1)
+    if attempts >= tonumber(ARGV[1]) then
+        redis.call("HDEL", KEYS[3], item)
+        redis.call("SADD", KEYS[5], item)
+    else
+        local delay = math.min(ARGV[2] * 2 ^ (attempts - 1), tonumber(ARGV[3]))
+        if delay > 0 then
+            redis.call("ZADD", KEYS[4], now + delay, item)
+        else
+            redis.call("SADD", KEYS[1], item)
+        end
+    end
+end
+return redis.call("ZREM", KEYS[2], unpack(ARGV, 4))
+"""
+
+
+def add_results(pipeline, key_result, key_result_stream, results):
+    """
+    Add commands storing results to their shards to the pipeline,
+    results are added to the stream as a single entry if stream key is given
+    """
+    for shard, shard_results in group_by_shard(results, len(key_result)).items():
+        pipeline.sadd(key_result[shard], *shard_results)
+    if key_result_stream is not None:
+        pipeline.xadd(key_result_stream, {str(index): result for index, result in enumerate(results)})
+    return pipeline
+
+
+def add_workload(pipeline, key_workload, workload, payload_store=None, key_payload=None):
+    """
+    Add commands storing encoded workload items to their shards to the pipeline,
+    bodies of large items are stored out of band if payload store is given
+    """
+    if payload_store is not None:
+        workload = payload_store.pack(pipeline, key_payload, workload)
+    for shard, items in group_by_shard(workload, len(key_workload)).items():
+        pipeline.sadd(key_workload[shard], *items)
+    return pipeline
+
+
+def encode_workload(codec, payload_store, workload):
+    """
+    :return: list of items as they are stored in workload, bodies of large items are not stored
+    """
+    workload = [codec.encode(item) for item in workload]
+    if payload_store is None:
+        return workload
+    return [payload_store.reference(item) for item in workload]
+
 
 class DistributedJobController:
     __slots__ = [
         '__redis_client',
 
         '__key_result',
+        '__key_result_stream',
         '__key_workload',
         '__key_nack',
         '__key_fanout',
+        '__key_notify',
+        '__lease_timeout',
+        '__key_payload',
+        '__codec',
+        '__result_codec',
+        '__payload_store',
+        '__func_extend',
     ]
 
     def __init__(
         self, redis_client,
-        key_result, key_workload, key_fanout, key_nack
+        key_result, key_result_stream, key_workload, key_fanout, key_nack, key_notify, key_payload, lease_timeout,
+        codec, result_codec, payload_store
     ):
         self.__redis_client = redis_client
+        self.__lease_timeout = lease_timeout
+        self.__codec = codec
+        self.__result_codec = result_codec
+        self.__payload_store = payload_store
+        self.__key_payload = key_payload
+        self.__func_extend = redis_client.register_script(LUA_EXTEND)
 
         self.__key_result = key_result
+        self.__key_result_stream = key_result_stream
         self.__key_workload = key_workload
         self.__key_fanout = key_fanout
         self.__key_nack = key_nack
+        self.__key_notify = key_notify
 
     def result(self, *results):
         if results:
-            self.__redis_client.sadd(self.__key_result, *results)
+            self._result_commands(results).execute()
 
     def fanout(self, workload):
-        (
-            self.__redis_client
-                .pipeline()
-                .incr(self.__key_fanout)
-                .sadd(self.__key_workload, *workload)
-                .execute()
+        self._fanout_commands(workload).execute()
+
+    def error(self, reason):
+        return Exception(reason)
+
+    def extend(self, *workload, timeout=None):
+        """
+        Extend lease of claimed tasks, should be called by long running tasks
+        before lease expires, otherwise task is returned back to workload
+        :param timeout: seconds from now, lease timeout of the job by default
+        """
+        return sum(self._extend_calls(workload, timeout))
+
+    def _result_commands(self, results):
+        """
+        Get pipeline writing results, results of different shards are not written in a transaction,
+        keys could be in different slots
+        """
+        return add_results(
+            self.__redis_client.pipeline(transaction=False), self.__key_result, self.__key_result_stream,
+            [self.__result_codec.encode(result) for result in results]
+        )
+
+    def _fanout_commands(self, workload):
+        """
+        Get pipeline adding workload and waking up idle workers
+        """
+        pipeline = self.__redis_client.pipeline(transaction=False).incr(self.__key_fanout)
+        workload = [self.__codec.encode(item) for item in workload]
+        return (
+            add_workload(pipeline, self.__key_workload, workload, self.__payload_store, self.__key_payload)
+                .rpush(self.__key_notify, 1)
+                .ltrim(self.__key_notify, 0, 0)
         )
 
+    def _extend_calls(self, workload, timeout):
+        """
+        Call extend script for tasks of every shard, calls of asyncio client return coroutines
+        """
+        workload = encode_workload(self.__codec, self.__payload_store, workload)
+        return [
+            self.__func_extend(keys=[self.__key_nack[shard]], args=[timeout or self.__lease_timeout, *items])
+            for shard, items in group_by_shard(workload, len(self.__key_nack)).items()
+        ]
+
+
+class AsyncDistributedJobController(DistributedJobController):
+    """
+    Controller passed to coroutine job functions, result and fanout should be awaited
+    """
+    __slots__ = []
+
+    async def result(self, *results):
+        if results:
+            await self._result_commands(results).execute()
+
+    async def fanout(self, workload):
+        await self._fanout_commands(workload).execute()
+
+    async def extend(self, *workload, timeout=None):
+        extended = 0
+        for call in self._extend_calls(workload, timeout):
+            extended += await call
+        return extended
+
+
+class BufferedDistributedJobController:
+    """
+    Per task controller collecting results and fanout in memory,
+    collected writes are flushed in the same transaction as task ack
+    """
+    __slots__ = [
+        '__controller',
+        '__results',
+        '__fanout',
+        '__fanout_calls',
+
+        '__key_result',
+        '__key_result_stream',
+        '__key_workload',
+        '__key_fanout',
+        '__key_notify',
+        '__key_payload',
+        '__codec',
+        '__result_codec',
+        '__payload_store',
+    ]
+
+    def __init__(
+        self, controller,
+        key_result, key_result_stream, key_workload, key_fanout, key_notify, key_payload,
+        codec, result_codec, payload_store
+    ):
+        self.__controller = controller
+        self.__results = []
+        self.__fanout = []
+        self.__fanout_calls = 0
+        self.__codec = codec
+        self.__result_codec = result_codec
+        self.__payload_store = payload_store
+        self.__key_payload = key_payload
+
+        self.__key_result = key_result
+        self.__key_result_stream = key_result_stream
+        self.__key_workload = key_workload
+        self.__key_fanout = key_fanout
+        self.__key_notify = key_notify
+
+    def result(self, *results):
+        self.__results.extend(self.__result_codec.encode(result) for result in results)
+
+    def fanout(self, workload):
+        self.__fanout_calls += 1
+        self.__fanout.extend(self.__codec.encode(item) for item in workload)
+
     def error(self, reason):
         return Exception(reason)
 
+    def extend(self, *workload, timeout=None):
+        return self.__controller.extend(*workload, timeout=timeout)
+
+    def flush(self, pipeline):
+        """
+        Add collected writes to the pipeline
+        """
+        if self.__results:
+            add_results(pipeline, self.__key_result, self.__key_result_stream, self.__results)
+        if self.__fanout_calls:
+            pipeline.incrby(self.__key_fanout, self.__fanout_calls)
+        if self.__fanout:
+            (
+                add_workload(pipeline, self.__key_workload, self.__fanout, self.__payload_store, self.__key_payload)
+                    .rpush(self.__key_notify, 1)
+                    .ltrim(self.__key_notify, 0, 0)
+            )
+        return pipeline
+
+
+class AsyncBufferedDistributedJobController(BufferedDistributedJobController):
+    """
+    Buffered controller for coroutine job functions
+    """
+    __slots__ = []
+
+    async def result(self, *results):
+        super().result(*results)
+
+    async def fanout(self, workload):
+        super().fanout(workload)
+
+
+class DistributedBatchController:
+    """
+    Controller passed to batch job functions, tracks per item outcome of the batch
+    """
+    __slots__ = [
+        '__controller',
+        '__codec',
+        '__payload_store',
+        '__acked',
+        '__failed',
+    ]
+
+    def __init__(self, controller, codec, payload_store=None):
+        self.__controller = controller
+        self.__codec = codec
+        self.__payload_store = payload_store
+        self.__acked = set()
+        self.__failed = set()
+
+    @property
+    def controller(self):
+        return self.__controller
+
+    @property
+    def acked(self):
+        """
+        Encoded items marked as processed
+        """
+        return self.__acked
+
+    @property
+    def failed(self):
+        """
+        Encoded items marked as failed
+        """
+        return self.__failed
+
+    def result(self, *results):
+        return self.__controller.result(*results)
+
+    def fanout(self, workload):
+        return self.__controller.fanout(workload)
+
+    def error(self, reason):
+        return self.__controller.error(reason)
+
+    def extend(self, *workload, timeout=None):
+        return self.__controller.extend(*workload, timeout=timeout)
+
+    def ack(self, *workload):
+        """
+        Mark items as processed even if the batch fails afterwards
+        """
+        self.__acked.update(encode_workload(self.__codec, self.__payload_store, workload))
+
+    def fail(self, *workload):
+        """
+        Return items back to workload, the rest of the batch is acked
+        """
+        self.__failed.update(encode_workload(self.__codec, self.__payload_store, workload))
+
 
 class DistributedJob:
     __slots__ = [
@@ -73,9 +398,25 @@ class DistributedJob:
         '__name',
         '__callback',
         '__controller',
+        '__batch_size',
+        '__buffered',
+        '__lease_timeout',
+        '__max_attempts',
+        '__retry_backoff',
+        '__shards',
+        '__tagged',
+        '__cluster',
+        '__codec',
+        '__result_codec',
+        '__payload_store',
+        '__metrics',
+        '__hooks',
+        '__rate_limit',
         '__run',
+        '__busy',
 
         '__key_result',
+        '__key_result_stream',
         '__key_workload',
         '__key_nack',
         '__key_tasks',
@@ -84,37 +425,114 @@ class DistributedJob:
         '__key_workers',
         '__key_success',
         '__key_error',
+        '__key_batch_success',
+        '__key_batch_error',
         '__key_fanout',
-        '__func_spopmove',
-        '__func_scard2',
+        '__key_notify',
+        '__key_done',
+        '__key_payload',
+        '__key_attempts',
+        '__key_retry',
+        '__key_dead',
+        '__key_autoscale',
+        '__key_rate_limit',
+        '__func_spopmove_many',
+        '__func_extend',
+        '__func_reap',
+        '__func_fail',
+        '__func_release',
+        '__func_take_tokens',
     ]
 
-    def __init__(self, name, callback, redis_pool):
+    def __init__(
+        self, name, callback, redis_pool,
+        batch_size=None, buffered=False, result_stream=False, lease_timeout=DEFAULT_LEASE_TIMEOUT,
+        max_attempts=None, retry_backoff=DEFAULT_RETRY_BACKOFF, shards=1, codec=None, payload_store=None,
+        hooks=None, rate_limit=None
+    ):
         self.logger = logging.getLogger('distributed')
-        self.__redis_client = redis.StrictRedis(connection_pool=redis_pool)
         self.__name = name
         self.__callback = callback
+        self.__batch_size = batch_size
+        self.__buffered = buffered
+        self.__lease_timeout = lease_timeout
+        self.__max_attempts = max_attempts
+        self.__retry_backoff = retry_backoff
+        self.__shards = shards
+        # items are strings and results are raw bytes unless codec is given
+        self.__codec = get_codec(codec or 'text')
+        self.__result_codec = get_codec(codec or 'raw')
+        self.__payload_store = payload_store
+        self.__hooks = None if hooks is None else GuardedHooks(hooks)
+        self.__rate_limit = get_rate_limit(rate_limit)
         self.__run = True
+        self.__busy = None
+
+        redis_client = get_redis_client(redis_pool)
+        self.__cluster = is_cluster(redis_client)
+        # keys of a shard are written in a single transaction, so they should stay in the same cluster slot
+        self.__tagged = shards > 1 or self.__cluster
+        if self.__tagged:
+            # hash tags keep keys of the shard in the slot of the shard and job wide keys in the slot of the job
+            job_name = '{{{}}}'.format(name)
+            shard_names = ['{{{}:{}}}'.format(name, shard) for shard in range(shards)]
+        else:
+            job_name = name
+            shard_names = [name]
+
+        # keys split by shard, items are assigned to shards by hash
+        self.__key_result = ['{}.result'.format(shard_name) for shard_name in shard_names]
+        self.__key_workload = ['{}.workload'.format(shard_name) for shard_name in shard_names]
+        self.__key_nack = ['{}.nack'.format(shard_name) for shard_name in shard_names]
+        self.__key_attempts = ['{}.attempts'.format(shard_name) for shard_name in shard_names]
+        self.__key_retry = ['{}.retry'.format(shard_name) for shard_name in shard_names]
+        self.__key_dead = ['{}.dead'.format(shard_name) for shard_name in shard_names]
+        self.__key_payload = ['{}.payload'.format(shard_name) for shard_name in shard_names]
+        # counters updated by ack are kept per shard and summed up by describe
+        self.__key_success = ['{}.success'.format(shard_name) for shard_name in shard_names]
+        self.__key_error = ['{}.error'.format(shard_name) for shard_name in shard_names]
+        self.__key_batch_success = ['{}.batch_success'.format(shard_name) for shard_name in shard_names]
+        self.__key_batch_error = ['{}.batch_error'.format(shard_name) for shard_name in shard_names]
+
+        self.__key_result_stream = '{}.result_stream'.format(job_name) if result_stream else None
+        self.__key_start_time = '{}.start_time'.format(job_name)
+        self.__key_end_time = '{}.end_time'.format(job_name)
+        self.__key_workers = '{}.workers'.format(job_name)
+        self.__key_fanout = '{}.fanout'.format(job_name)
+        self.__key_notify = '{}.notify'.format(job_name)
+        self.__key_done = '{}.done'.format(job_name)
+        self.__key_autoscale = '{}.autoscale'.format(job_name)
+        self.__key_rate_limit = '{}.rate_limit'.format(job_name)
+        self.__metrics = TaskMetrics(job_name)
 
-        self.__key_result = '{}.result'.format(name)
-        self.__key_workload = '{}.workload'.format(name)
-        self.__key_nack = '{}.nack'.format(name)
-        self.__key_start_time = '{}.start_time'.format(name)
-        self.__key_end_time = '{}.end_time'.format(name)
-        self.__key_workers = '{}.workers'.format(name)
-        self.__key_success = '{}.success'.format(name)
-        self.__key_error = '{}.error'.format(name)
-        self.__key_fanout = '{}.fanout'.format(name)
+        self.__connect(redis_client)
+
+    def __connect(self, redis_client):
+        """
+        Register scripts and controller using the client
+        """
+        self.__redis_client = redis_client
 
-        self.__func_spopmove = self.__redis_client.register_script(LUA_SPOPMOVE)
-        self.__func_scard2 = self.__redis_client.register_script(LUA_SCARD2)
+        self.__func_spopmove_many = self.__redis_client.register_script(LUA_SPOPMOVE_MANY)
+        self.__func_extend = self.__redis_client.register_script(LUA_EXTEND)
+        self.__func_reap = self.__redis_client.register_script(LUA_REAP)
+        self.__func_fail = self.__redis_client.register_script(LUA_FAIL)
+        self.__func_release = self.__redis_client.register_script(LUA_RELEASE)
+        self.__func_take_tokens = self.__redis_client.register_script(LUA_TAKE_TOKENS)
 
         self.__controller = DistributedJobController(
             redis_client=self.__redis_client,
             key_result=self.__key_result,
+            key_result_stream=self.__key_result_stream,
             key_workload=self.__key_workload,
             key_fanout=self.__key_fanout,
-            key_nack=self.__key_nack
+            key_nack=self.__key_nack,
+            key_notify=self.__key_notify,
+            key_payload=self.__key_payload,
+            lease_timeout=self.__lease_timeout,
+            codec=self.__codec,
+            result_codec=self.__result_codec,
+            payload_store=self.__payload_store
         )
 
     @property
@@ -125,126 +543,983 @@ class DistributedJob:
     def action(self):
         return self.__callback
 
+    @property
+    def redis_client(self):
+        return self.__redis_client
+
     @property
     def results(self):
-        yield from self.__redis_client.sscan_iter(self.__key_result)
+        for key_result in self.__key_result:
+            for result in self.__redis_client.sscan_iter(key_result):
+                yield self.__result_codec.decode(result)
+
+    def iter_results(self, last_id='0', block=True, count=DEFAULT_CHUNK_SIZE):
+        """
+        Iterate over results while job is running, job should be created with result_stream=True.
+        Every entry holds results of a single result call (or of a buffered task)
+        :param last_id: stream id to continue after, '0' to read from the beginning
+        :param block: wait for new results until all workload is processed
+        :param count: max amount of entries fetched in a single round trip
+        :return: generator of (stream id, list of results)
+        """
+        if self.__key_result_stream is None:
+            raise Exception('Job {} has no result stream'.format(self.__name))
+
+        finished = not block
+        while True:
+            entries = self.__redis_client.xread(
+                {self.__key_result_stream: last_id},
+                count=count,
+                block=None if finished else IDLE_TIMEOUT * 1000
+            )
+            if entries:
+                for last_id, fields in entries[0][1]:
+                    yield last_id, [self.__result_codec.decode(fields[index]) for index in sorted(fields, key=int)]
+                continue
+
+            if finished:
+                return
+
+            # read the rest of the stream once workload is processed
+            finished = not self.__remaining()
+
+    def __count_remaining(self, pipeline, shards=None):
+        """
+        Add commands counting queued, in progress and delayed tasks of the shards to the pipeline
+        :param shards: shard indexes, all shards by default
+        """
+        for shard in range(self.__shards) if shards is None else shards:
+            (
+                pipeline
+                    .scard(self.__key_workload[shard])
+                    .zcard(self.__key_nack[shard])
+                    .zcard(self.__key_retry[shard])
+            )
+        return pipeline
+
+    def __remaining(self):
+        """
+        :return: amount of queued, in progress and delayed tasks
+        """
+        return sum(self.__count_remaining(self.__redis_client.pipeline(transaction=False)).execute())
+
+    def __count_queued(self, pipeline):
+        """
+        Add commands counting queued tasks of all shards to the pipeline
+        """
+        for key_workload in self.__key_workload:
+            pipeline.scard(key_workload)
+        return pipeline
+
+    def __queued(self):
+        """
+        :return: True if any shard has queued tasks
+        """
+        return any(self.__count_queued(self.__redis_client.pipeline(transaction=False)).execute())
+
+    def __shard_client(self, shard, redis_client=None):
+        """
+        Client running transactions and pipelined scripts on keys of the shard.
+        Pipelines of redis cluster client support neither, so the node owning the slot of the shard is used directly
+        :param redis_client: asyncio client, the job client by default
+        """
+        if redis_client is not None:
+            return redis_client
+        if self.__cluster:
+            return self.__redis_client.get_node_from_key(self.__key_workload[shard]).redis_connection
+        return self.__redis_client
+
+    def __refresh_slots(self):
+        """
+        Reload slots of the cluster, shard could be moved to another node
+        """
+        if self.__cluster:
+            self.__redis_client.nodes_manager.initialize()
+
+    def __home_shard(self, shard=None):
+        return random.randrange(self.__shards) if shard is None else shard
+
+    def __shard_order(self, shard):
+        """
+        Claim order of shards, the home shard first and the rest to steal from
+        """
+        return [(shard + index) % self.__shards for index in range(self.__shards)]
 
-    def callback(self, args):
+    def callback(self, args, prefetch=1, shard=None):
         """
         Single threaded function that invokes job processing
+        :param prefetch: amount of tasks to claim in a single round trip,
+            claimed tasks are processed one by one from the local buffer
+            (or batch by batch if job has batch size), lease of the buffer is extended while it waits
+        :param shard: shard to claim from, other shards are tried once it runs dry.
+            Random shard by default
+        :return: amount of claimed tasks
         """
-        workload = self.__func_spopmove(keys=[self.__key_workload, self.__key_nack])
-        if workload is None:
+        if self.__batch_size:
+            prefetch = max(prefetch, self.__batch_size)
+        if self.__rate_limit is not None:
+            # tokens are taken before claim, so claimed tasks do not wait for them holding the lease
+            prefetch = self.__rate_limit.acquire(
+                self.__func_take_tokens, self.__key_rate_limit, prefetch, pending=self.__queued
+            )
+
+        claimed = time.monotonic()
+        workload = []
+        if prefetch:
+            for shard, workload in self.__claim_calls(self.__func_spopmove_many, self.__home_shard(shard), prefetch):
+                if workload:
+                    break
+
+        workload = self.__claimed(prefetch, workload, claimed)
+        if not workload:
             # no task currently in queue
-            return
+            self.__metrics.flush(self.__redis_client.pipeline(), force=True).execute()
+            return 0
+
+        leased = claimed
+        for index, chunk in enumerate(self.__chunks(workload)):
+            leased = self.__keep_lease(shard, workload[index * (self.__batch_size or 1):], leased)
+            self.__process(chunk, args)
+
+        return len(workload)
+
+    def __claim_calls(self, func_spopmove_many, shard, count):
+        """
+        Call claim script on shards in claim order, calls of asyncio script return coroutines.
+        Caller stops iterating once a shard has workload
+        :param shard: home shard
+        :return: iterator of (shard, claimed tasks)
+        """
+        for shard in self.__shard_order(shard):
+            yield shard, func_spopmove_many(
+                keys=[self.__key_workload[shard], self.__key_nack[shard]], args=[count, self.__lease_timeout]
+            )
+
+    def __claimed(self, count, workload, claimed):
+        """
+        Keep tokens not spent on claimed tasks and report the claim
+        :param count: amount of requested tasks
+        :param claimed: monotonic time the claim started
+        """
+        self.__release_tokens(count - len(workload))
+        if workload and self.__hooks is not None:
+            self.__hooks.on_claim(self.__name, len(workload), time.monotonic() - claimed)
+        return workload
+
+    def __chunks(self, workload):
+        """
+        Split claimed tasks into units of a job function call, batches or single tasks
+        """
+        if self.__batch_size:
+            return list(chunk_workload(workload, size=self.__batch_size))
+        return [[item] for item in workload]
+
+    def __keep_lease(self, shard, workload, leased):
+        """
+        Extend lease of claimed tasks waiting in the local buffer once half of the lease is spent,
+        otherwise prefetched tasks expire and run twice while the previous ones are processed
+        :param workload: tasks of the shard not yet processed
+        :param leased: monotonic time of the last lease
+        :return: monotonic time of the last lease
+        """
+        # deadline is set in whole seconds of redis time, so the lease lasts at least lease_timeout - 1
+        if time.monotonic() - leased < (self.__lease_timeout - 1) / 2:
+            return leased
+        self.__func_extend(keys=[self.__key_nack[shard]], args=[self.__lease_timeout, *workload])
+        return time.monotonic()
+
+    async def __keep_lease_async(self, func_extend, shard, workload, leased):
+        if time.monotonic() - leased < (self.__lease_timeout - 1) / 2:
+            return leased
+        await func_extend(keys=[self.__key_nack[shard]], args=[self.__lease_timeout, *workload])
+        return time.monotonic()
 
-        workload = workload.decode('utf-8')
-        self.logger.debug('{}: processing job {}...'.format(self.__name, workload[:LOG_TRIM]))
+    def __release_tokens(self, count):
+        """
+        Keep tokens not spent on claimed tasks for the next claim
+        """
+        if self.__rate_limit is not None and count:
+            self.__rate_limit.release(count)
 
+    def __process(self, workload, args):
+        """
+        Invoke job function for the claimed task or batch and ack it
+        :param workload: claimed tasks, a single one unless job has batch size
+        """
+        bodies = workload
+        if self.__payload_store is not None:
+            bodies = [self.__payload_store.unpack(self.__redis_client, self.__key_payload, item) for item in workload]
+            workload, bodies, missing = self.__split_missing(workload, bodies)
+            if missing:
+                self.__execute_ack(self.__ack(self.__controller, dead=missing), len(missing))
+            if not workload:
+                return
+
+        controller, state, started = self.__call_started(BufferedDistributedJobController, self.__controller, workload)
         try:
-            self.__callback(self.__controller, workload, *args)
+            items = [self.__codec.decode(body) for body in bodies]
+            self.__callback(controller, items if self.__batch_size else items[0], *args)
         except Exception as e:
-            self.logger.error(e)
-            # Error occurred, remove task from nack and add it back to workload
-            (
-                self.__redis_client.pipeline()
-                                   .incr(self.__key_error)
-                                   .sadd(self.__key_workload, workload)
-                                   .srem(self.__key_nack, workload)
-                                   .execute()
-            )
+            ack = self.__call_finished(controller, workload, started, state, e)
         else:
-            # No errors happend, ack task, update counters
-            (
-                self.__redis_client.pipeline()
-                                   .incr(self.__key_success)
-                                   .srem(self.__key_nack, workload)
-                                   .execute()
+            ack = self.__call_finished(controller, workload, started, state)
+        self.__execute_ack(ack, len(workload))
+
+    async def __process_async(self, redis_client, controller, workload, args):
+        bodies = workload
+        if self.__payload_store is not None:
+            bodies = [
+                await self.__payload_store.unpack_async(redis_client, self.__key_payload, item) for item in workload
+            ]
+            workload, bodies, missing = self.__split_missing(workload, bodies)
+            if missing:
+                await self.__execute_ack_async(
+                    redis_client, self.__ack(controller, dead=missing, redis_client=redis_client), len(missing)
+                )
+            if not workload:
+                return
+
+        controller, state, started = self.__call_started(AsyncBufferedDistributedJobController, controller, workload)
+        try:
+            items = [self.__codec.decode(body) for body in bodies]
+            await self.__callback(controller, items if self.__batch_size else items[0], *args)
+        except Exception as e:
+            ack = self.__call_finished(controller, workload, started, state, e, redis_client=redis_client)
+        else:
+            ack = self.__call_finished(controller, workload, started, state, redis_client=redis_client)
+        await self.__execute_ack_async(redis_client, ack, len(workload))
+
+    def __split_missing(self, workload, bodies):
+        """
+        Split off tasks whose body is missing in the payload store, they could never succeed
+        :param bodies: bodies loaded from the payload store, None if missing or expired
+        :return: tasks with loaded body, their bodies and tasks with missing body
+        """
+        missing = [item for item, body in zip(workload, bodies) if body is None]
+        if missing:
+            self.logger.error('{}: body of {} tasks is missing or expired, moved to dead set'.format(
+                self.__name, len(missing)
+            ))
+        return (
+            [item for item, body in zip(workload, bodies) if body is not None],
+            [body for body in bodies if body is not None],
+            missing,
+        )
+
+    def __call_started(self, buffered_class, controller, workload):
+        """
+        Get controller of the job function call and record the call start
+        :return: controller, value returned by before_call hook and monotonic start time
+        """
+        if self.__batch_size:
+            self.logger.debug('{}: processing batch of {} jobs...'.format(self.__name, len(workload)))
+        else:
+            self.logger.debug('{}: processing job {}...'.format(self.__name, trim_log(workload[0])))
+
+        controller = self.__task_controller(buffered_class, controller)
+        if self.__batch_size:
+            controller = DistributedBatchController(controller, self.__codec, self.__payload_store)
+        state = self.__hooks and self.__hooks.before_call(self.__name, len(workload))
+        return controller, state, time.monotonic()
+
+    def __call_finished(self, controller, workload, started, state, error=None, redis_client=None):
+        """
+        Record timing of finished job function call
+        :param state: value returned by before_call hook
+        :param error: exception raised by job function
+        :param redis_client: asyncio client, the job client by default
+        :return: ack of the tasks, see __ack
+        """
+        elapsed = time.monotonic() - started
+        self.__metrics.record(elapsed / len(workload), len(workload))
+        if self.__hooks is not None:
+            self.__hooks.after_call(self.__name, len(workload), elapsed, error, state)
+        if error is not None:
+            self.logger.error(error)
+
+        if self.__batch_size:
+            return self.__ack_batch(controller, workload, success=error is None, redis_client=redis_client)
+        if error is None:
+            return self.__ack(controller, done=workload, redis_client=redis_client)
+        return self.__ack(controller, failed=workload, redis_client=redis_client)
+
+    def __task_controller(self, buffered_class, controller):
+        """
+        Get controller for a single task, buffered jobs get a new buffered controller per task
+        """
+        if not self.__buffered:
+            return controller
+
+        return buffered_class(
+            controller=controller,
+            key_result=self.__key_result,
+            key_result_stream=self.__key_result_stream,
+            key_workload=self.__key_workload,
+            key_fanout=self.__key_fanout,
+            key_notify=self.__key_notify,
+            key_payload=self.__key_payload,
+            codec=self.__codec,
+            result_codec=self.__result_codec,
+            payload_store=self.__payload_store
+        )
+
+    def __ack(self, controller, done=(), failed=(), dead=(), batch=None, redis_client=None):
+        """
+        Get pipelines acking processed tasks and returning failed ones back to workload.
+        Tasks are claimed together from a single shard, so all of them belong to the same shard
+        and are acked in a transaction of the shard. Buffered writes are flushed only if some tasks were processed.
+        Writes to other slots are sent before the transaction if keys are hash tagged,
+        so a failure in between repeats the task instead of losing its writes
+        :param dead: tasks moved straight to dead set
+        :param batch: True or False if tasks are a processed or failed batch
+        :param redis_client: asyncio client, the job client by default
+        :return: list of pipelines to execute in order, the last one results in remaining tasks of the shard,
+            and True if it also results in keys of released payload bodies just before them
+        """
+        shard = shard_of((done or failed or dead)[0], self.__shards)
+        transaction = self.__shard_client(shard, redis_client).pipeline()
+        if self.__tagged:
+            pipeline = (redis_client or self.__redis_client).pipeline(transaction=False)
+        else:
+            pipeline = transaction
+
+        if done and isinstance(controller, BufferedDistributedJobController):
+            controller.flush(pipeline)
+        if batch is not None:
+            transaction.incr(self.__key_batch_success[shard] if batch else self.__key_batch_error[shard])
+        if failed:
+            transaction.incrby(self.__key_error[shard], len(failed))
+            if self.__max_attempts is None:
+                transaction.sadd(self.__key_workload[shard], *failed)
+            else:
+                # retry with backoff, move to dead set once attempts are exhausted
+                call_script(
+                    transaction, self.__func_fail,
+                    keys=[
+                        self.__key_workload[shard], self.__key_nack[shard], self.__key_attempts[shard],
+                        self.__key_retry[shard], self.__key_dead[shard]
+                    ],
+                    args=[self.__max_attempts, self.__retry_backoff, MAX_RETRY_SLEEP, *failed]
+                )
+        if dead:
+            transaction.incrby(self.__key_error[shard], len(dead)).sadd(self.__key_dead[shard], *dead)
+        if done:
+            transaction.incrby(self.__key_success[shard], len(done))
+        if self.__max_attempts is not None and (done or dead):
+            transaction.hdel(self.__key_attempts[shard], *done, *dead)
+
+        transaction.zrem(self.__key_nack[shard], *done, *failed, *dead)
+        # timings are flushed along with the ack once flush interval passed
+        self.__metrics.flush(pipeline)
+        released = False
+        if done and self.__payload_store is not None:
+            # released after fanout and zrem, so body of the item queued again is kept
+            released = self.__payload_store.release(
+                transaction, self.__func_release, self.__key_payload,
+                [
+                    self.__key_workload[shard], self.__key_nack[shard],
+                    self.__key_retry[shard], self.__key_dead[shard]
+                ],
+                done
             )
+        self.__count_remaining(transaction, shards=[shard])
+        return [transaction] if pipeline is transaction else [pipeline, transaction], released
+
+    def __execute_ack(self, ack, count):
+        """
+        Execute ack pipelines, notify waiting clients if the last task was acked.
+        Other shards are checked only once the shard of acked tasks is empty
+        :param ack: pipelines and release flag returned by __ack
+        :param count: amount of acked tasks
+        """
+        pipelines, released = ack
+        acked = time.monotonic()
+        for pipeline in pipelines:
+            results = pipeline.execute()
+
+        if released:
+            self.__payload_store.delete(results[-4])
+        if self.__acked(results, count, acked) and (self.__shards == 1 or not self.__remaining()):
+            self.__notify_done(self.__redis_client.pipeline()).execute()
+
+    async def __execute_ack_async(self, redis_client, ack, count):
+        pipelines, released = ack
+        acked = time.monotonic()
+        for pipeline in pipelines:
+            results = await pipeline.execute()
+
+        if released:
+            self.__payload_store.delete(results[-4])
+        if not self.__acked(results, count, acked):
+            return
+        pipeline = redis_client.pipeline(transaction=False)
+        if self.__shards == 1 or not sum(await self.__count_remaining(pipeline).execute()):
+            await self.__notify_done(redis_client.pipeline()).execute()
+
+    def __acked(self, results, count, acked):
+        """
+        Report the ack
+        :param results: results of the last ack pipeline
+        :param acked: monotonic time the ack started
+        :return: True if the shard of acked tasks has no remaining tasks
+        """
+        if self.__hooks is not None:
+            self.__hooks.on_ack(self.__name, count, time.monotonic() - acked)
+        return not sum(results[-3:])
+
+    def __ack_batch(self, controller, workload, success, redis_client=None):
+        """
+        Get ack of processed batch, if batch failed
+        only explicitly acked items are considered processed
+        """
+        acked = workload if success else controller.acked
+        done = [item for item in workload if item in acked and item not in controller.failed]
+        failed = [item for item in workload if item not in done]
+
+        return self.__ack(controller.controller, done=done, failed=failed, batch=success, redis_client=redis_client)
 
     def describe(self):
         """
         Get job statistics
         """
-        in_progress = sum(self.__func_scard2(keys=[self.__key_workload, self.__key_nack])) > 0
-        start_time = parse_int(self.__redis_client.get(self.__key_start_time))
-        end_time = parse_int(self.__redis_client.get(self.__key_end_time))
+        return self._parse_description(
+            self._describe_commands(self.__redis_client.pipeline(transaction=False)).execute()
+        )
+
+    def _describe_commands(self, pipeline):
+        """
+        Add commands collecting job statistics to the pipeline, see describe_many
+        """
+        # cluster pipeline does not support mget, counters are read one by one
+        (
+            pipeline
+                .get(self.__key_start_time)
+                .get(self.__key_end_time)
+                .get(self.__key_workers)
+                .hgetall(self.__key_autoscale)
+        )
+        for shard in range(self.__shards):
+            (
+                pipeline
+                    .scard(self.__key_workload[shard])
+                    .zcard(self.__key_nack[shard])
+                    .zcard(self.__key_retry[shard])
+                    .scard(self.__key_result[shard])
+                    .scard(self.__key_dead[shard])
+                    .get(self.__key_error[shard])
+                    .get(self.__key_batch_success[shard])
+                    .get(self.__key_batch_error[shard])
+            )
+        return self.__metrics.describe_commands(pipeline)
+
+    def _parse_description(self, results):
+        """
+        :param results: results of commands added by _describe_commands
+        """
+        start_time, end_time, workers = (parse_int(value) for value in results[:3])
+        metrics = self.__metrics.parse_description(results[-2:])
+        # sharded counters are summed up over all shards
+        workload, nack, retry, result, dead = (sum(results[4 + index:-2:8]) for index in range(5))
+        errors, batch_success, batch_errors = (
+            sum(parse_int(value) for value in results[9 + index:-2:8]) for index in range(3)
+        )
+
+        # autoscaled worker processes which reported recently
+        autoscale = {}
+        for worker_id, state in results[3].items():
+            state = json.loads(state)
+            if state['updated'] >= time.time() - AUTOSCALE_TTL:
+                autoscale[worker_id.decode('utf-8')] = state
+
+        in_progress = workload + nack + retry > 0
         if in_progress:
             end_time = int(time.time())
 
         return {
             'type': 'distributed',
-            'workers': parse_int(self.__redis_client.get(self.__key_workers)),
+            'workers': workers,
             'in_progress': in_progress,
             'duration': end_time - start_time,
-            'results': parse_int(self.__redis_client.scard(self.__key_result)),
-            'workload': parse_int(self.__redis_client.scard(self.__key_workload)),
-            'errors': parse_int(self.__redis_client.get(self.__key_error)),
+            'results': result,
+            'workload': workload,
+            'errors': errors,
+            'batch_success': batch_success,
+            'batch_errors': batch_errors,
+            'retry': retry,
+            'dead': dead,
             'tech_name': self.__name,
+            'autoscale': autoscale,
+            **metrics,
         }
 
-    def distribute(self, workload, chunk_len=DEFAULT_CHUNK_SIZE):
+    def distribute(
+        self, workload,
+        chunk_len=DEFAULT_CHUNK_SIZE, chunk_bytes=DEFAULT_CHUNK_BYTES, window=DEFAULT_WINDOW, on_progress=None
+    ):
         """
-        Start distributed job
+        Start distributed job. Workload is streamed to redis, so workers
+        start processing as soon as the first chunk is loaded
+        :param workload: iterable of items, for example generator or file lines
+        :param chunk_len: max amount of items sent in a single command, 0 to send everything at once
+        :param chunk_bytes: max total length of items sent in a single command
+        :param window: amount of chunks sent in a single pipelined round trip
+        :param on_progress: callable receiving amount of loaded items after each round trip
+        :return: amount of loaded items
         """
+        workload = map(self.__codec.encode, workload)
         if chunk_len:
-            workload = chunk_workload(workload, size=DEFAULT_CHUNK_SIZE)
+            workload = chunk_workload(workload, size=chunk_len, max_bytes=chunk_bytes)
         else:
-            workload = (workload,)
+            workload = iter((list(workload),))
 
-        pipeline = self.__redis_client.pipeline()
+        # keys of different slots could not be reset in a single transaction,
+        # cluster pipeline deletes a single key per call and does not chain delete
+        pipeline = self.__redis_client.pipeline(transaction=not self.__tagged)
+        if self.__key_result_stream is not None:
+            pipeline.delete(self.__key_result_stream)
+        for shard in range(self.__shards):
+            for key in (
+                self.__key_result, self.__key_workload, self.__key_nack,
+                self.__key_attempts, self.__key_retry, self.__key_dead,
+            ):
+                pipeline.delete(key[shard])
+            (
+                pipeline
+                    .set(self.__key_success[shard], 0)
+                    .set(self.__key_error[shard], 0)
+                    .set(self.__key_batch_success[shard], 0)
+                    .set(self.__key_batch_error[shard], 0)
+            )
+        pipeline.delete(self.__key_done)
         (
             pipeline
-                .delete(self.__key_result)
-                .delete(self.__key_workload)
-                .delete(self.__key_nack)
                 .set(self.__key_start_time, int(time.time()))
                 .set(self.__key_end_time, 0)
                 .set(self.__key_workers, 0)
-                .set(self.__key_success, 0)
-                .set(self.__key_error, 0)
                 .set(self.__key_fanout, 0)
         )
+
+        loaded = 0
         for chunk in workload:
-            pipeline.sadd(self.__key_workload, *chunk)
+            if chunk:
+                self.__notify(add_workload(
+                    pipeline, self.__key_workload, chunk, self.__payload_store, self.__key_payload
+                ))
+                loaded += len(chunk)
             break
 
         pipeline.execute()
+        if on_progress is not None:
+            on_progress(loaded)
 
+        pipeline = self.__redis_client.pipeline(transaction=False)
+        chunks = 0
         for chunk in workload:
-            self.__redis_client.sadd(self.__key_workload, *chunk)
+            add_workload(pipeline, self.__key_workload, chunk, self.__payload_store, self.__key_payload)
+            loaded += len(chunk)
+            chunks += 1
 
-    def cancel(self):
-        (
-            self.__redis_client
-                .pipeline()
-                .delete(self.__key_workload)
-                .set(self.__key_end_time, int(time.time()))
-                .execute()
+            if chunks >= window:
+                self.__notify(pipeline).execute()
+                chunks = 0
+                if on_progress is not None:
+                    on_progress(loaded)
+
+        if len(pipeline):
+            self.__notify(pipeline).execute()
+            if on_progress is not None:
+                on_progress(loaded)
+
+        return loaded
+
+    def __notify_done(self, pipeline):
+        """
+        Wake up clients waiting for results, the list holds at most one item
+        """
+        return (
+            pipeline
+                .rpush(self.__key_done, 1)
+                .ltrim(self.__key_done, 0, 0)
+        )
+
+    def __notify(self, pipeline):
+        """
+        Wake up idle workers, the notification list holds at most one item
+        """
+        return (
+            pipeline
+                .rpush(self.__key_notify, 1)
+                .ltrim(self.__key_notify, 0, 0)
         )
 
-    def wait_results(self):
+    def cancel(self):
+        pipeline = self.__redis_client.pipeline(transaction=not self.__tagged)
+        for shard in range(self.__shards):
+            pipeline.delete(self.__key_workload[shard])
+            pipeline.delete(self.__key_retry[shard])
+        pipeline.delete(self.__key_notify)
+        pipeline.set(self.__key_end_time, int(time.time())).execute()
+
+    def replay_dead(self):
+        """
+        Return tasks which exhausted their attempts back to workload
+        :return: amount of returned tasks
+        """
+        replayed = 0
+        # every shard is replayed in its own transaction on the node owning its slot
+        for shard in range(self.__shards):
+            replayed += (
+                self.__shard_client(shard).pipeline()
+                    .sunionstore(self.__key_workload[shard], self.__key_workload[shard], self.__key_dead[shard])
+                    .scard(self.__key_dead[shard])
+                    .delete(self.__key_dead[shard])
+                    .execute()
+            )[1]
+        self.__notify(self.__redis_client.pipeline(transaction=False)).execute()
+        return replayed
+
+    def wait_results(self, timeout=None, on_progress=None, poll_interval=WAIT_POLL_INTERVAL):
+        """
+        Block until all workload is processed. Worker acking the last task wakes up waiting clients,
+        remaining workload is additionally checked every poll_interval seconds
+        :param timeout: max seconds to wait, None to wait forever
+        :param on_progress: callable receiving amount of queued and in progress tasks on every check
+        :return: True if workload is processed, False on timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+
         while True:
-            if sum(self.__func_scard2(keys=[self.__key_workload, self.__key_nack])) == 0:
-                break
-            time.sleep(0.001)
+            remaining = self.__remaining()
+            if on_progress is not None:
+                on_progress(remaining)
+
+            if not remaining:
+                # pass notification to other waiting clients
+                self.__notify_done(self.__redis_client.pipeline()).execute()
+                return True
+
+            wait = poll_interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return False
 
-    def start_bulk(self, concurrency=1, pool_args=()):
+            self.__redis_client.blpop(self.__key_done, timeout=wait)
+
+    def start_bulk(self, concurrency=1, pool_args=(), prefetch=1):
         concurrency, pool_args = self._normalize_pool_args(concurrency, pool_args)
         pool = ThreadPool(processes=concurrency)
-        self._run_forever(task=lambda: pool.map(self.callback, pool_args))
+        self._run_forever(task=lambda: sum(pool.map(lambda args: self.callback(args, prefetch), pool_args)))
+
+    def start_threaded(self, concurrency=1, pool_args=(), prefetch=1, autoscale=None):
+        """
+        Start concurrent workers in threads
+        :param concurrency: amount of worker threads, ignored if pool_args given
+        :param pool_args: list of additional job function arguments, one item per thread
+        :param prefetch: amount of tasks each worker claims in a single round trip
+        :param autoscale: workload.autoscale.Autoscale, max_threads (or pool_args) threads are started
+            and only the amount of them chosen by autoscale processes workload, the rest is parked
+        """
+        if autoscale is not None:
+            return self.__start_autoscaled(autoscale, pool_args, prefetch)
 
-    def start_threaded(self, concurrency=1, pool_args=()):
         concurrency, pool_args = self._normalize_pool_args(concurrency, pool_args)
         pool = ThreadPool(processes=concurrency)
 
         pool.map(
-            lambda args: self.start_single(*args),
+            lambda args: self.start_single(*args, prefetch=prefetch),
             pool_args
         )
 
-    def start_single(self, *args):
-        self._run_forever(task=lambda: self.callback(args))
+    def __start_autoscaled(self, autoscale, pool_args, prefetch):
+        """
+        Start worker threads and scale amount of active ones until stopped,
+        the last decision of every process is reported in describe
+        """
+        concurrency, pool_args = self._normalize_pool_args(autoscale.max_threads, pool_args)
+        worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+        # autoscale observes calls as a hook
+        hooks = self.__hooks
+        self.__hooks = GuardedHooks(autoscale) if hooks is None else ChainHooks(hooks, autoscale)
+
+        self.__run = True
+        threads = [
+            threading.Thread(target=self.__run_autoscaled, args=(autoscale, index, args, prefetch), daemon=True)
+            for index, args in enumerate(pool_args)
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while self.__run:
+                decided = time.time()
+                while self.__run and time.time() - decided < autoscale.interval:
+                    time.sleep(min(IDLE_TIMEOUT, autoscale.interval))
+
+                backlog = sum(self.__count_remaining(self.__redis_client.pipeline(transaction=False)).execute()[::3])
+                threads_limit = autoscale.update(backlog)
+                self.logger.debug('{}: {} threads active, {}'.format(self.__name, threads_limit, autoscale.decision))
+                (
+                    self.__redis_client.pipeline()
+                        .hset(self.__key_autoscale, worker_id, json.dumps({
+                            'threads': threads_limit,
+                            'decision': autoscale.decision,
+                            'updated': time.time(),
+                        }))
+                        .expire(self.__key_autoscale, AUTOSCALE_TTL)
+                        .execute()
+                )
+        finally:
+            self.__run = False
+            for thread in threads:
+                thread.join()
+            self.__hooks = hooks
+            self.__redis_client.hdel(self.__key_autoscale, worker_id)
+
+    def __run_autoscaled(self, autoscale, index, args, prefetch):
+        """
+        Worker thread processes workload while it is active and parks otherwise
+        """
+        shard = self.__home_shard()
+
+        def task():
+            # parked or stopped thread leaves processing loop right after the current task
+            if self.__run and autoscale.is_active(index):
+                return self.callback(args, prefetch, shard)
+            return 0
+
+        while self.__run:
+            if autoscale.wait_active(index, timeout=IDLE_TIMEOUT):
+                self.__run_worker(task, active=lambda: autoscale.is_active(index))
+
+    def start_single(self, *args, prefetch=1, shard=None):
+        """
+        Start a single worker
+        :param shard: home shard of the worker, random by default
+        """
+        shard = self.__home_shard(shard)
+        self._run_forever(task=lambda: self.callback(args, prefetch, shard))
+
+    def start_processes(self, concurrency=1, pool_args=(), prefetch=1):
+        """
+        Start concurrent workers in forked processes, suitable for CPU bound jobs.
+        The call supervises worker processes and restarts the dead ones until stopped
+        :param concurrency: amount of worker processes, ignored if pool_args given
+        :param pool_args: list of additional job function arguments, one item per process
+        :param prefetch: amount of tasks each worker claims in a single round trip
+        """
+        concurrency, pool_args = self._normalize_pool_args(concurrency, pool_args)
+        context = multiprocessing.get_context('fork')
+        workers = [None] * concurrency
+
+        self.__run = True
+        try:
+            while self.__run:
+                for index, args in enumerate(pool_args):
+                    if workers[index] is not None:
+                        process, busy = workers[index]
+                        if process.is_alive():
+                            continue
+
+                        self.logger.error('{}: worker process {} exited with code {}, restarting'.format(
+                            self.__name, process.pid, process.exitcode
+                        ))
+                        self.__release_worker(process, busy)
+
+                    busy = context.Value('i', 0)
+                    process = context.Process(
+                        target=self._start_process,
+                        args=(args, prefetch, busy),
+                        daemon=True
+                    )
+                    process.start()
+                    workers[index] = (process, busy)
+
+                wait([process.sentinel for process, _ in workers], timeout=IDLE_TIMEOUT)
+        finally:
+            for worker in workers:
+                if worker is None:
+                    continue
+
+                process, busy = worker
+                process.terminate()
+                self.__release_worker(process, busy)
+
+    def _start_process(self, args, prefetch, busy):
+        """
+        Worker process entry point, connections inherited from the parent are not reused.
+        Cluster client drops inherited connections of its nodes by itself
+        """
+        if not self.__cluster:
+            pool = self.__redis_client.connection_pool
+            self.__connect(get_redis_client(pool.__class__(
+                connection_class=pool.connection_class,
+                max_connections=pool.max_connections,
+                **pool.connection_kwargs
+            )))
+        self.__busy = busy
+        self.start_single(*args, prefetch=prefetch)
+
+    def __release_worker(self, process, busy):
+        """
+        Fix workers counter if the process died while processing workload
+        """
+        process.join()
+        if busy.value:
+            self.__redis_client.decrby(self.__key_workers, busy.value)
+
+    def __track_busy(self, amount):
+        if self.__busy is None:
+            return
+
+        with self.__busy.get_lock():
+            self.__busy.value += amount
+
+    def start_async(self, concurrency=100, args=(), prefetch=1):
+        """
+        Process workload with asyncio until stopped, job function should be a coroutine function.
+        The engine is counted as a single worker
+        :param concurrency: amount of tasks in flight
+        :param args: additional job function arguments
+        :param prefetch: amount of tasks to claim in a single round trip
+        """
+        asyncio.run(self.process_async(concurrency=concurrency, args=args, prefetch=prefetch))
+
+    async def process_async(self, concurrency=100, args=(), prefetch=1):
+        """
+        Coroutine version of start_async to run inside of existing event loop
+        """
+        if not asyncio.iscoroutinefunction(self.__callback):
+            raise Exception('Job {} function should be a coroutine function'.format(self.__name))
+        if self.__cluster:
+            raise Exception('Job {}: asyncio engine does not support redis cluster client'.format(self.__name))
+
+        redis_client = create_async_redis(self.__redis_client.connection_pool)
+        func_spopmove_many = redis_client.register_script(LUA_SPOPMOVE_MANY)
+        func_extend = redis_client.register_script(LUA_EXTEND)
+        func_take_tokens = redis_client.register_script(LUA_TAKE_TOKENS)
+        controller = AsyncDistributedJobController(
+            redis_client=redis_client,
+            key_result=self.__key_result,
+            key_result_stream=self.__key_result_stream,
+            key_workload=self.__key_workload,
+            key_fanout=self.__key_fanout,
+            key_nack=self.__key_nack,
+            key_notify=self.__key_notify,
+            key_payload=self.__key_payload,
+            lease_timeout=self.__lease_timeout,
+            codec=self.__codec,
+            result_codec=self.__result_codec,
+            payload_store=self.__payload_store
+        )
+
+        if self.__batch_size:
+            prefetch = max(prefetch, self.__batch_size)
+        slots = asyncio.Semaphore(concurrency)
+        tasks = set()
+        home_shard = self.__home_shard()
+
+        async def queued():
+            return any(await self.__count_queued(redis_client.pipeline(transaction=False)).execute())
+
+        async def claim():
+            count = prefetch
+            if self.__rate_limit is not None:
+                count = await self.__rate_limit.acquire_async(
+                    func_take_tokens, self.__key_rate_limit, count, pending=queued
+                )
+
+            claimed = time.monotonic()
+            shard, workload = home_shard, []
+            if count:
+                for shard, call in self.__claim_calls(func_spopmove_many, home_shard, count):
+                    workload = await call
+                    if workload:
+                        break
+            return shard, claimed, self.__claimed(count, workload, claimed)
+
+        async def process(workload):
+            try:
+                await self.__process_async(redis_client, controller, workload, args)
+            except Exception as e:
+                # tasks which were not acked are returned to workload once their lease expires
+                self.logger.error('{}: failed to process, reason {}'.format(self.__name, e))
+            finally:
+                slots.release()
+
+        exception_tries = 0
+        reap_at, workload = 0, None
+
+        self.__run = True
+        try:
+            while self.__run:
+                try:
+                    if not workload and time.monotonic() >= reap_at:
+                        reaped, retried, workload = (
+                            sum(counts) for counts in zip(*await self.__reap_commands(
+                                redis_client.pipeline(transaction=False), range(self.__shards)
+                            ).execute())
+                        )
+                        self.__log_reaped(reaped, retried)
+                        reap_at = time.monotonic() + self.__reap_interval()
+
+                    if not workload:
+                        # block until distribute or fanout adds workload
+                        await self.__metrics.flush(redis_client.pipeline(), force=True).execute()
+                        workload = await redis_client.blpop(self.__key_notify, timeout=IDLE_TIMEOUT)
+                        continue
+
+                    workload = None
+                    # pass notification to the next idle worker
+                    await self.__notify(redis_client.pipeline()).execute()
+
+                    try:
+                        await redis_client.incr(self.__key_workers)
+
+                        while self.__run:
+                            await slots.acquire()
+                            try:
+                                shard, leased, workload = await claim()
+                            except Exception:
+                                slots.release()
+                                raise
+                            if not workload:
+                                slots.release()
+                                break
+
+                            for index, chunk in enumerate(self.__chunks(workload)):
+                                if index:
+                                    # tasks waiting for a free slot keep their lease
+                                    await slots.acquire()
+                                    try:
+                                        leased = await self.__keep_lease_async(
+                                            func_extend, shard, workload[index * (self.__batch_size or 1):], leased
+                                        )
+                                    except Exception:
+                                        slots.release()
+                                        raise
+                                task = asyncio.ensure_future(process(chunk))
+                                tasks.add(task)
+                                task.add_done_callback(tasks.discard)
+
+                        # tasks in flight could fanout more workload
+                        await asyncio.gather(*tasks)
+
+                        self.logger.info('{}: finished processing'.format(self.__name))
+                    finally:
+                        await redis_client.decr(self.__key_workers)
+                        await redis_client.set(self.__key_end_time, int(time.time()))
+                except Exception as e:
+                    exception_tries += 1
+                    self.logger.error('{}: exception during processing loop. Increasing wait time. {}'.format(
+                        self.__name, e
+                    ))
+                    await asyncio.sleep(min(2 ** exception_tries, MAX_RETRY_SLEEP))
+                else:
+                    exception_tries = 0
+        finally:
+            await redis_client.connection_pool.disconnect()
 
     def _normalize_pool_args(self, concurrency=1, pool_args=()):
         if not pool_args:
@@ -253,42 +1528,183 @@ class DistributedJob:
         return concurrency, pool_args
 
     def _run_forever(self, task):
+        """
+        Process workload until stopped
+        :param task: callable processing workload, returns falsy value if there is nothing to process
+        """
+        self.__run = True
+        self.__run_worker(task)
+
+    def __run_worker(self, task, active=None):
+        """
+        Process workload until stopped or until active returns False
+        """
         exception_tries = 0
+        reap_at, workload = 0, None
 
-        self.__run = True
-        while self.__run:
+        while self.__run and (active is None or active()):
             try:
-                if not parse_int(self.__redis_client.scard(self.__key_workload)):
-                    time.sleep(1)
+                if not workload and time.monotonic() >= reap_at:
+                    # return tasks of dead workers and due retries back to workload
+                    reaped, retried, workload = (sum(counts) for counts in zip(*self.__reap_shards()))
+                    self.__log_reaped(reaped, retried)
+                    reap_at = time.monotonic() + self.__reap_interval()
+
+                if not workload:
+                    # block until distribute or fanout adds workload
+                    self.__metrics.flush(self.__redis_client.pipeline(), force=True).execute()
+                    workload = self.__redis_client.blpop(self.__key_notify, timeout=IDLE_TIMEOUT)
                     continue
 
+                workload = None
+                # pass notification to the next idle worker
+                self.__notify(self.__redis_client.pipeline()).execute()
+
                 try:
                     self.__redis_client.incr(self.__key_workers)
+                    self.__track_busy(1)
 
-                    while parse_int(self.__redis_client.scard(self.__key_workload)):
-                        task()
-                        time.sleep(0.001)
+                    while task():
+                        pass
 
                     self.logger.info('{}: finished processing'.format(self.__name))
                 finally:
                     self.__redis_client.decr(self.__key_workers)
+                    self.__track_busy(-1)
                     self.__redis_client.set(self.__key_end_time, int(time.time()))
             except Exception as e:
                 exception_tries += 1
                 self.logger.error('{}: exception during processing loop. Increasing wait time. {}'.format(
                     self.__name, e
                 ))
+                self.__refresh_slots()
                 time.sleep(min(2 ** exception_tries, MAX_RETRY_SLEEP))
             else:
                 exception_tries = 0
 
+    def reap(self):
+        """
+        Return tasks with expired lease and due retries back to workload,
+        idle workers do it automatically twice per lease_timeout
+        :return: amount of returned tasks
+        """
+        reaped = retried = 0
+        while True:
+            chunks = self.__reap_shards()
+            for reaped_chunk, retried_chunk, _ in chunks:
+                reaped += reaped_chunk
+                retried += retried_chunk
+            if all(max(reaped_chunk, retried_chunk) < REAP_CHUNK_SIZE for reaped_chunk, retried_chunk, _ in chunks):
+                break
+
+        if reaped or retried:
+            self.__notify(self.__redis_client.pipeline()).execute()
+        self.__log_reaped(reaped, retried)
+        return reaped + retried
+
+    def __reap_interval(self):
+        """
+        Idle workers reap twice per lease, in between they only wait for notification
+        """
+        return max(self.__lease_timeout / 2, IDLE_TIMEOUT)
+
+    def __reap_commands(self, pipeline, shards):
+        """
+        Add commands returning tasks with expired lease and due retries of the shards back to workload
+        to the pipeline, each command results in (reaped, retried, workload size) of the shard
+        """
+        for shard in shards:
+            call_script(
+                pipeline, self.__func_reap,
+                keys=[self.__key_workload[shard], self.__key_nack[shard], self.__key_retry[shard]],
+                args=[REAP_CHUNK_SIZE]
+            )
+        return pipeline
+
+    def __reap_shards(self):
+        """
+        Reap every shard in a single round trip per redis node
+        :return: list of (reaped, retried, workload size) of every shard
+        """
+        nodes = {}
+        for shard in range(self.__shards):
+            nodes.setdefault(self.__shard_client(shard), []).append(shard)
+
+        results = {}
+        for redis_client, shards in nodes.items():
+            pipeline = self.__reap_commands(redis_client.pipeline(transaction=False), shards)
+            results.update(zip(shards, pipeline.execute()))
+        return [results[shard] for shard in range(self.__shards)]
+
+    def start_reaper(self, interval=IDLE_TIMEOUT):
+        """
+        Standalone loop returning tasks with expired lease and due retries back to workload
+        """
+        exception_tries = 0
+
+        self.__run = True
+        while self.__run:
+            try:
+                self.reap()
+            except Exception as e:
+                exception_tries += 1
+                self.logger.error('{}: exception during reaping. Increasing wait time. {}'.format(
+                    self.__name, e
+                ))
+                self.__refresh_slots()
+                time.sleep(min(2 ** exception_tries, MAX_RETRY_SLEEP))
+            else:
+                exception_tries = 0
+                time.sleep(interval)
+
+    def __log_reaped(self, reaped, retried):
+        if reaped:
+            self.logger.warning('{}: {} tasks with expired lease returned to workload'.format(self.__name, reaped))
+        if retried:
+            self.logger.info('{}: {} tasks returned to workload for retry'.format(self.__name, retried))
+
     def stop_processing(self):
         self.__run = False
 
 
-def distributed(name, redis_pool):
+def distributed(
+    name, redis_pool,
+    batch_size=None, buffered=False, result_stream=False, lease_timeout=DEFAULT_LEASE_TIMEOUT,
+    max_attempts=None, retry_backoff=DEFAULT_RETRY_BACKOFF, shards=1, codec=None, payload_store=None,
+    hooks=None, rate_limit=None
+):
+    """
+    Make distributed job out of function
+    :param name: job name, used as prefix for redis keys
+    :param redis_pool: redis connection pool or redis client, for example redis.RedisCluster
+    :param batch_size: if set function receives list of up to batch_size items instead of single item
+    :param buffered: collect results and fanout of the task in memory and write them
+        in the same transaction as task ack
+    :param result_stream: additionally add results to redis stream to consume them while job is running
+    :param lease_timeout: seconds after which claimed but not acked task is returned back to workload,
+        long running tasks should extend the lease
+    :param max_attempts: if set failed task is retried with exponential backoff and moved to dead set
+        after max_attempts failures, otherwise it is returned back to workload immediately
+    :param retry_backoff: delay in seconds before the first retry, doubled for every next attempt
+    :param shards: amount of sets the workload is split into, shard keys are hash tagged
+        to be spread over redis cluster slots. Workers claim from their home shard first
+        and steal from the other shards once it runs dry
+    :param codec: codec or codec name applied to workload items and results, see workload.codec.
+        By default items are strings and results are returned as raw bytes
+    :param payload_store: keep bodies of large items out of workload, see workload.payload.
+        Only a short reference is added to workload, the body is loaded when the task is processed
+        and deleted once it is acked. Tasks whose body is missing or expired are moved to dead set
+    :param hooks: instrumentation hooks invoked around claim, job function call and ack, see workload.hooks
+    :param rate_limit: tasks per second, (tasks per second, burst) or workload.ratelimit.RateLimit.
+        The limit is shared by all workers of the job
+    """
     def decorator(func):
-        return DistributedJob(name, func, redis_pool=redis_pool)
+        return DistributedJob(
+            name, func, redis_pool=redis_pool,
+            batch_size=batch_size, buffered=buffered, result_stream=result_stream, lease_timeout=lease_timeout,
+            max_attempts=max_attempts, retry_backoff=retry_backoff, shards=shards, codec=codec,
+            payload_store=payload_store, hooks=hooks, rate_limit=rate_limit
+        )
     return decorator
 
 
@@ -0,0 +1,219 @@
+import os
+import random
+import pstats
+import logging
+import cProfile
+import threading
+import tracemalloc
+
+
+LOG = logging.getLogger('workload.hooks')
+
+
+class Hooks:
+    """
+    Instrumentation interface, override methods of interest.
+    Timings are monotonic seconds, count is amount of tasks (size of batch)
+    """
+    __slots__ = []
+
+    def on_claim(self, job_name, count, elapsed):
+        pass
+
+    def before_call(self, job_name, count):
+        """
+        :return: state passed to after_call of the same call
+        """
+        return None
+
+    def after_call(self, job_name, count, elapsed, error, state):
+        """
+        :param error: exception raised by job function, None if call succeeded
+        """
+        pass
+
+    def on_ack(self, job_name, count, elapsed):
+        pass
+
+
+class GuardedHooks(Hooks):
+    """
+    Log and swallow exceptions of hooks, so instrumentation never fails or loses a task
+    """
+    __slots__ = [
+        '__hooks',
+    ]
+
+    def __init__(self, hooks):
+        self.__hooks = hooks
+
+    def on_claim(self, job_name, count, elapsed):
+        try:
+            self.__hooks.on_claim(job_name, count, elapsed)
+        except Exception as e:
+            LOG.error('{}: on_claim hook failed, reason {}'.format(job_name, e))
+
+    def before_call(self, job_name, count):
+        try:
+            return self.__hooks.before_call(job_name, count)
+        except Exception as e:
+            LOG.error('{}: before_call hook failed, reason {}'.format(job_name, e))
+            return None
+
+    def after_call(self, job_name, count, elapsed, error, state):
+        try:
+            self.__hooks.after_call(job_name, count, elapsed, error, state)
+        except Exception as e:
+            LOG.error('{}: after_call hook failed, reason {}'.format(job_name, e))
+
+    def on_ack(self, job_name, count, elapsed):
+        try:
+            self.__hooks.on_ack(job_name, count, elapsed)
+        except Exception as e:
+            LOG.error('{}: on_ack hook failed, reason {}'.format(job_name, e))
+
+
+class ChainHooks(Hooks):
+    """
+    Invoke several hooks in order, failure of one of them does not affect the others
+    """
+    __slots__ = [
+        '__hooks',
+    ]
+
+    def __init__(self, *hooks):
+        self.__hooks = [GuardedHooks(hooks_item) for hooks_item in hooks]
+
+    def on_claim(self, job_name, count, elapsed):
+        for hooks in self.__hooks:
+            hooks.on_claim(job_name, count, elapsed)
+
+    def before_call(self, job_name, count):
+        return [hooks.before_call(job_name, count) for hooks in self.__hooks]
+
+    def after_call(self, job_name, count, elapsed, error, state):
+        for hooks, hooks_state in zip(self.__hooks, state):
+            hooks.after_call(job_name, count, elapsed, error, hooks_state)
+
+    def on_ack(self, job_name, count, elapsed):
+        for hooks in self.__hooks:
+            hooks.on_ack(job_name, count, elapsed)
+
+
+class SamplingProfiler(Hooks):
+    """
+    Profile 1 in every calls of job function with cProfile and optionally tracemalloc.
+    Stats of sampled calls slower than threshold are aggregated per job
+    and dumped to the directory as {job name}.{pid}.prof (and .memory.txt).
+    Only a single call per process is profiled at a time, python 3.12 allows a single active profiler.
+    Calls of other threads and coroutines overlapping the sampled one are skipped or profiled along
+    :param directory: directory to dump stats to
+    :param every: sample 1 in every calls, 1 to profile every call
+    :param slower_than: seconds, faster sampled calls are discarded
+    :param memory: trace memory allocations of sampled calls
+    """
+    __slots__ = [
+        '__directory',
+        '__every',
+        '__slower_than',
+        '__memory',
+        '__lock',
+        '__active',
+        '__stats',
+        '__allocations',
+        '__peaks',
+    ]
+
+    MEMORY_TOP = 50
+
+    def __init__(self, directory, every=100, slower_than=0, memory=False):
+        self.__directory = directory
+        self.__every = every
+        self.__slower_than = slower_than
+        self.__memory = memory
+        self.__lock = threading.Lock()
+        self.__active = False
+        self.__stats = {}
+        self.__allocations = {}
+        self.__peaks = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def before_call(self, job_name, count):
+        if random.randrange(self.__every):
+            return None
+        with self.__lock:
+            if self.__active:
+                return None
+            self.__active = True
+
+        # memory tracing is process wide as well, tracing started by somebody else is left alone
+        tracing = False
+        try:
+            tracing = self.__memory and not tracemalloc.is_tracing()
+            if tracing:
+                tracemalloc.start()
+
+            profile = cProfile.Profile()
+            profile.enable()
+        except Exception:
+            self.__release(tracing)
+            raise
+        return profile, tracing
+
+    def after_call(self, job_name, count, elapsed, error, state):
+        if state is None:
+            return
+
+        profile, tracing = state
+        snapshot = peak = None
+        try:
+            profile.disable()
+            if tracing:
+                snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, __file__)])
+                peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            self.__release(tracing)
+
+        if elapsed < self.__slower_than:
+            return
+
+        with self.__lock:
+            self.__dump_profile(job_name, profile)
+            if snapshot is not None:
+                self.__dump_memory(job_name, snapshot, peak)
+
+    def __release(self, tracing):
+        """
+        Stop memory tracing started by the sampled call and let the next call be sampled
+        """
+        if tracing:
+            tracemalloc.stop()
+        with self.__lock:
+            self.__active = False
+
+    def __get_path(self, job_name, suffix):
+        return os.path.join(self.__directory, '{}.{}.{}'.format(job_name, os.getpid(), suffix))
+
+    def __dump_profile(self, job_name, profile):
+        if job_name in self.__stats:
+            self.__stats[job_name].add(profile)
+        else:
+            self.__stats[job_name] = pstats.Stats(profile)
+        self.__stats[job_name].dump_stats(self.__get_path(job_name, 'prof'))
+
+    def __dump_memory(self, job_name, snapshot, peak):
+        """
+        Allocations still alive at the end of sampled calls are summed up, peak is the max of sampled calls
+        """
+        self.__peaks[job_name] = max(self.__peaks.get(job_name, 0), peak)
+        allocations = self.__allocations.setdefault(job_name, {})
+        for stat in snapshot.statistics('lineno'):
+            line = str(stat.traceback)
+            size, count = allocations.get(line, (0, 0))
+            allocations[line] = (size + stat.size, count + stat.count)
+
+        top = sorted(allocations.items(), key=lambda item: item[1][0], reverse=True)[:self.MEMORY_TOP]
+        with open(self.__get_path(job_name, 'memory.txt'), 'w') as f:
+            f.write('peak={}\n'.format(self.__peaks[job_name]))
+            for line, (size, count) in top:
+                f.write('{}: size={} count={}\n'.format(line, size, count))
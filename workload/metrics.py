@@ -0,0 +1,131 @@
+import time
+import bisect
+import threading
+
+from .utils import LATENCY_BUCKETS, METRICS_FLUSH_INTERVAL, THROUGHPUT_WINDOW, parse_int
+
+
+# hash fields of histogram buckets, the last bucket counts tasks slower than all bounds
+BUCKET_FIELDS = ['{:g}'.format(bound) for bound in LATENCY_BUCKETS] + ['+Inf']
+
+
+def get_window_key(key_window, window):
+    return '{}.{}'.format(key_window, window)
+
+
+class TaskMetrics:
+    """
+    Fixed bucket histogram of task latency since the job start and the same histogram
+    of every THROUGHPUT_WINDOW seconds window reporting recent throughput and percentiles.
+    Timings are aggregated locally and flushed to redis at most once per interval,
+    so recording a task costs no round trip
+    """
+    __slots__ = [
+        '__key_latency',
+        '__key_window',
+        '__interval',
+        '__lock',
+        '__counts',
+        '__total',
+        '__flushed',
+    ]
+
+    def __init__(self, name, interval=METRICS_FLUSH_INTERVAL):
+        self.__key_latency = '{}.latency'.format(name)
+        self.__key_window = '{}.window'.format(name)
+        self.__interval = interval
+        self.__lock = threading.Lock()
+        self.__counts = [0] * len(BUCKET_FIELDS)
+        self.__total = 0.0
+        self.__flushed = time.monotonic()
+
+    def record(self, seconds, count=1):
+        """
+        :param seconds: processing time of a single task
+        :param count: amount of tasks processed in the same time each, e.g. size of batch
+        """
+        index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self.__lock:
+            self.__counts[index] += count
+            self.__total += seconds * count
+
+    def flush(self, pipeline, force=False):
+        """
+        Add commands storing aggregated timings to the pipeline if flush interval passed
+        """
+        with self.__lock:
+            if not any(self.__counts) or (not force and time.monotonic() - self.__flushed < self.__interval):
+                return pipeline
+
+            counts, total = self.__counts, self.__total
+            self.__counts = [0] * len(BUCKET_FIELDS)
+            self.__total = 0.0
+            self.__flushed = time.monotonic()
+
+        # tasks are counted in fixed time windows as well, a window expires once it is no longer reported
+        key = get_window_key(self.__key_window, int(time.time()) // THROUGHPUT_WINDOW)
+        for field, count in zip(BUCKET_FIELDS, counts):
+            if count:
+                pipeline.hincrby(self.__key_latency, field, count).hincrby(key, field, count)
+        (
+            pipeline
+                .hincrbyfloat(self.__key_latency, 'sum', total)
+                .hincrby(key, 'count', sum(counts))
+                .expire(key, THROUGHPUT_WINDOW * 2)
+        )
+        return pipeline
+
+    def describe_commands(self, pipeline):
+        """
+        Add commands reading stored metrics to the pipeline, see parse_description
+        """
+        # the last complete window is reported
+        window = int(time.time()) // THROUGHPUT_WINDOW - 1
+        return (
+            pipeline
+                .hgetall(self.__key_latency)
+                .hgetall(get_window_key(self.__key_window, window))
+        )
+
+    def parse_description(self, results):
+        """
+        :param results: results of commands added by describe_commands
+        :return: dict of tasks per second and latency percentiles of the last complete window,
+            latency histogram since the job start
+        """
+        latency, recent = (
+            {field.decode('utf-8'): value for field, value in hash_value.items()} for hash_value in results
+        )
+        counts = [parse_int(latency.get(field)) for field in BUCKET_FIELDS]
+        recent_counts = [parse_int(recent.get(field)) for field in BUCKET_FIELDS]
+
+        return {
+            'throughput': round(parse_int(recent.get('count')) / THROUGHPUT_WINDOW, 2),
+            'latency_p50': percentile(recent_counts, 0.5),
+            'latency_p99': percentile(recent_counts, 0.99),
+            'latency': {
+                'buckets': counts,
+                'sum': float(latency.get('sum', 0)),
+                'count': sum(counts),
+            },
+        }
+
+
+def percentile(counts, q):
+    """
+    Estimate percentile of histogram as upper bound of the bucket it falls into
+    :param counts: count of every bucket of LATENCY_BUCKETS
+    :param q: quantile between 0 and 1
+    :return: seconds or None if histogram is empty
+    """
+    total = sum(counts)
+    if not total:
+        return None
+
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS, counts):
+        seen += count
+        if seen >= total * q:
+            return bound
+    # slower than all bounds
+    return LATENCY_BUCKETS[-1]
@@ -0,0 +1,203 @@
+import os
+import uuid
+import hashlib
+
+from abc import ABC, abstractmethod
+from .utils import DEFAULT_PAYLOAD_THRESHOLD, DEFAULT_PAYLOAD_TTL, shard_of, call_script
+
+
+INLINE = b'='
+REFERENCE = b'@'
+
+# equal items share the content addressed body, it is released only if the item is not queued again.
+# KEYS are workload, nack, retry and dead sets of the shard followed by body keys of referenced items
+LUA_RELEASE = """
+local released = {}
+for i = 2, #ARGV do
+    local item = ARGV[i]
+    if redis.call("SISMEMBER", KEYS[1], item) == 0
+        and not redis.call("ZSCORE", KEYS[2], item)
+        and not redis.call("ZSCORE", KEYS[3], item)
+        and redis.call("SISMEMBER", KEYS[4], item) == 0 then
+        if ARGV[1] == "1" then
+            redis.call("DEL", KEYS[3 + i])
+        end
+        released[#released + 1] = KEYS[3 + i]
+    end
+end
+return released
+"""
+
+
+def get_key(key_payload, reference):
+    """
+    :param key_payload: prefixes of payload keys, one per shard.
+        Body is kept in the shard of its reference, so it is released in the same transaction as the task
+    """
+    prefix = key_payload[shard_of(reference, len(key_payload))]
+    return '{}.{}'.format(prefix, reference[1:].decode('utf-8'))
+
+
+class PayloadStore(ABC):
+    """
+    Keeps encoded items longer than threshold bytes out of the workload,
+    only a short content addressed reference travels through redis sets.
+    Every item is prefixed with a byte telling if it is a reference
+    """
+    __slots__ = [
+        'threshold',
+    ]
+    # bodies are redis keys deleted by the release script itself
+    in_redis = False
+
+    def __init__(self, threshold=DEFAULT_PAYLOAD_THRESHOLD):
+        self.threshold = threshold
+
+    @abstractmethod
+    def save(self, pipeline, key, data):
+        """
+        Store the body, redis writes are added to the pipeline
+        """
+
+    @abstractmethod
+    def load(self, redis_client, key):
+        """
+        :return: stored body, None if it is missing or expired
+        """
+
+    @abstractmethod
+    async def load_async(self, redis_client, key):
+        """
+        :return: stored body, redis_client is an asyncio client
+        """
+
+    @abstractmethod
+    def delete(self, keys):
+        """
+        Delete released bodies once the ack is executed
+        :param keys: keys of released bodies, result of the release command
+        """
+
+    def reference(self, item):
+        """
+        :return: encoded item as it is stored in workload
+        """
+        if len(item) < self.threshold:
+            return INLINE + item
+        return REFERENCE + hashlib.blake2b(item, digest_size=16).hexdigest().encode('utf-8')
+
+    def pack(self, pipeline, key_payload, workload):
+        """
+        Add commands storing bodies of large items to the pipeline
+        :param key_payload: prefixes of payload keys, one per shard
+        :return: list of items to add to workload
+        """
+        packed = []
+        for item in workload:
+            reference = self.reference(item)
+            if reference[:1] == REFERENCE:
+                self.save(pipeline, get_key(key_payload, reference), item)
+            packed.append(reference)
+        return packed
+
+    def unpack(self, redis_client, key_payload, item):
+        """
+        :return: encoded item, the body is loaded if item is a reference.
+            None if the body is missing or expired
+        """
+        if item[:1] == INLINE:
+            return item[1:]
+        return self.load(redis_client, get_key(key_payload, item))
+
+    async def unpack_async(self, redis_client, key_payload, item):
+        if item[:1] == INLINE:
+            return item[1:]
+        return await self.load_async(redis_client, get_key(key_payload, item))
+
+    def release(self, pipeline, func_release, key_payload, key_queues, workload):
+        """
+        Add command releasing bodies of processed items to the pipeline,
+        the command results in keys of released bodies, see delete
+        :param func_release: LUA_RELEASE script registered with redis client
+        :param key_queues: keys of workload, nack, retry and dead sets of the shard
+        :return: True if the command was added, no command is needed if no item is a reference
+        """
+        references = [item for item in workload if item[:1] == REFERENCE]
+        if references:
+            call_script(
+                pipeline, func_release,
+                keys=[*key_queues, *(get_key(key_payload, item) for item in references)],
+                args=[int(self.in_redis), *references]
+            )
+        return bool(references)
+
+
+class RedisPayloadStore(PayloadStore):
+    """
+    Bodies are stored in redis keys expiring after ttl seconds,
+    so bodies of tasks which are never acked are not kept forever.
+    Ttl should exceed the job lifetime, task with expired body is moved to dead set
+    """
+    __slots__ = [
+        'ttl',
+    ]
+    in_redis = True
+
+    def __init__(self, threshold=DEFAULT_PAYLOAD_THRESHOLD, ttl=DEFAULT_PAYLOAD_TTL):
+        super().__init__(threshold)
+        self.ttl = ttl
+
+    def save(self, pipeline, key, data):
+        return pipeline.set(key, data, ex=self.ttl)
+
+    def load(self, redis_client, key):
+        return redis_client.get(key)
+
+    async def load_async(self, redis_client, key):
+        return await redis_client.get(key)
+
+    def delete(self, keys):
+        # keys are already deleted by the release script within the ack transaction
+        pass
+
+
+class SpoolPayloadStore(PayloadStore):
+    """
+    Bodies are stored as files of the local directory, suitable only
+    if the client and all workers run on the same host
+    """
+    __slots__ = [
+        '__directory',
+    ]
+
+    def __init__(self, directory, threshold=DEFAULT_PAYLOAD_THRESHOLD):
+        super().__init__(threshold)
+        self.__directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, pipeline, key, data):
+        path = os.path.join(self.__directory, key)
+        if not os.path.exists(path):
+            # readers never see partially written file
+            temp_path = '{}.{}'.format(path, uuid.uuid4().hex)
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        return pipeline
+
+    def load(self, redis_client, key):
+        try:
+            with open(os.path.join(self.__directory, key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    async def load_async(self, redis_client, key):
+        return self.load(redis_client, key)
+
+    def delete(self, keys):
+        for key in keys:
+            try:
+                os.remove(os.path.join(self.__directory, key.decode('utf-8')))
+            except FileNotFoundError:
+                pass
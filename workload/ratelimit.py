@@ -0,0 +1,144 @@
+import time
+import asyncio
+import threading
+
+
+# bucket is refilled by elapsed redis server time, so clocks of workers do not matter
+LUA_TAKE_TOKENS = """
+redis.replicate_commands()
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local now = redis.call("TIME")
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+
+local granted = math.min(requested, math.floor(tokens))
+tokens = tokens - granted
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+-- full bucket is the same as no bucket
+redis.call("PEXPIRE", KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+
+local wait = 0
+if granted == 0 then
+    wait = (1 - tokens) / rate
+end
+return {granted, tostring(wait)}
+"""
+
+
+class RateLimit:
+    """
+    Token bucket shared by all workers of a job, tasks are started at most rate times per second.
+    Tokens are taken from redis in batches and spent locally,
+    so the limiter does not add a round trip per task. Local tokens not spent within a time worth
+    of the batch expire, so tokens kept by idle workers do not add up to a burst
+    :param rate: tasks per second
+    :param burst: bucket capacity, amount of tasks which could be started at once after a pause
+    :param batch: tokens taken in a single round trip, tenth of a second worth of tokens by default
+    """
+    __slots__ = [
+        'rate',
+        'burst',
+        'batch',
+        '__lock',
+        '__tokens',
+        '__expires',
+    ]
+
+    def __init__(self, rate, burst=None, batch=None):
+        if rate <= 0:
+            raise Exception('Rate limit should be positive')
+
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.batch = batch or max(1, min(int(self.burst), int(rate / 10)))
+        self.__lock = threading.Lock()
+        self.__tokens = 0
+        self.__expires = 0
+
+    def acquire(self, func_take_tokens, key, count=1, pending=None):
+        """
+        Take up to count tokens, wait until at least one token is available
+        :param func_take_tokens: LUA_TAKE_TOKENS script registered with redis client
+        :param key: redis key of the bucket
+        :param pending: optional callable, returns False if there is no workload to take tokens for.
+            It is checked only before waiting, so idle worker does not wait for tokens it does not need
+        :return: amount of taken tokens, 0 if there is no workload
+        """
+        while True:
+            taken, wait = self.take(func_take_tokens, key, count)
+            if taken:
+                return taken
+
+            if pending is not None and not pending():
+                return 0
+            time.sleep(wait)
+
+    def take(self, func_take_tokens, key, count=1):
+        """
+        Take up to count tokens without waiting
+        :return: tuple of (amount of taken tokens, seconds until a token is available if none was taken)
+        """
+        taken = self.__take(count)
+        if taken:
+            return taken, 0
+
+        granted, wait = func_take_tokens(keys=[key], args=[self.rate, self.burst, max(count, self.batch)])
+        self.__grant(granted)
+        return self.__take(count), float(wait)
+
+    async def acquire_async(self, func_take_tokens, key, count=1, pending=None):
+        """
+        Coroutine version of acquire, pending is a coroutine function
+        """
+        while True:
+            taken = self.__take(count)
+            if taken:
+                return taken
+
+            granted, wait = await func_take_tokens(keys=[key], args=[self.rate, self.burst, max(count, self.batch)])
+            self.__grant(granted)
+            if not granted:
+                if pending is not None and not await pending():
+                    return 0
+                await asyncio.sleep(float(wait))
+
+    def release(self, count):
+        """
+        Return unused tokens to the local pool, they expire along with the tokens of the last batch
+        """
+        with self.__lock:
+            self.__tokens += count
+
+    def __grant(self, count):
+        """
+        Add tokens taken from redis to the local pool
+        """
+        with self.__lock:
+            self.__tokens += count
+            self.__expires = time.monotonic() + self.batch / self.rate
+
+    def __take(self, count):
+        with self.__lock:
+            if time.monotonic() >= self.__expires:
+                self.__tokens = 0
+            taken = min(count, self.__tokens)
+            self.__tokens -= taken
+            return taken
+
+
+def get_rate_limit(rate_limit):
+    """
+    :param rate_limit: RateLimit instance, tasks per second or (tasks per second, burst)
+    :return: RateLimit instance or None if rate_limit is None
+    """
+    if rate_limit is None or isinstance(rate_limit, RateLimit):
+        return rate_limit
+    if isinstance(rate_limit, tuple):
+        return RateLimit(*rate_limit)
+    return RateLimit(rate_limit)
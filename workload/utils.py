@@ -1,6 +1,42 @@
+import time
+import zlib
+import weakref
+import redis
+
+
 LOG_TRIM = 20
 MAX_RETRY_SLEEP = 60
 DEFAULT_CHUNK_SIZE = 100
+DEFAULT_CHUNK_BYTES = 1024 * 1024
+DEFAULT_WINDOW = 10
+# blocking waits should stay below socket timeout of redis client (5 seconds by default)
+IDLE_TIMEOUT = 2
+# the shortest blocking wait for a task
+MIN_WAIT_TIMEOUT = 0.01
+RECLAIM_TIMEOUT = 300
+WAIT_POLL_INTERVAL = 2
+DEFAULT_LEASE_TIMEOUT = 60
+REAP_CHUNK_SIZE = 1000
+DEFAULT_RETRY_BACKOFF = 1
+COMPRESSION_THRESHOLD = 1024
+DEFAULT_PAYLOAD_THRESHOLD = 64 * 1024
+DEFAULT_PAYLOAD_TTL = 24 * 60 * 60
+METRICS_FLUSH_INTERVAL = 10
+THROUGHPUT_WINDOW = 60
+# upper bounds of task latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+AUTOSCALE_INTERVAL = 5
+# autoscaling state of workers which did not report for longer is considered stale
+AUTOSCALE_TTL = 60
+# scheduled task which no running cycle process claimed for longer is removed from the schedule
+SCHEDULE_STALE_TIMEOUT = 24 * 60 * 60
+# delayed tasks are promoted at least that often, in case the worker woken up for the earliest one died
+PROMOTE_INTERVAL = 30
+# scripts are loaded again that often, redis loses them on restart or failover
+SCRIPT_LOAD_INTERVAL = 60
+
+# monotonic time each registered script was last loaded at
+SCRIPT_LOADED = weakref.WeakKeyDictionary()
 
 
 def parse_int(int_str, default=0):
@@ -10,18 +46,167 @@ def parse_int(int_str, default=0):
         return default
 
 
-def chunk_workload(workload, size):
+def trim_log(data):
+    """
+    Readable beginning of encoded payload for logs
+    """
+    return data[:LOG_TRIM].decode('utf-8', 'replace')
+
+
+def chunk_workload(workload, size, max_bytes=None):
     """
     Splits workload into multiple chunks,
     to iteratively add large amount of data into redis
-    Currently split happens only by number of elements
+    Split happens by number of elements and optionally by total length of elements
     """
     chunk = []
+    chunk_bytes = 0
     for item in workload:
         chunk.append(item)
-        if len(chunk) >= size:
+        if max_bytes:
+            chunk_bytes += len(item)
+
+        if len(chunk) >= size or (max_bytes and chunk_bytes >= max_bytes):
             yield chunk
             chunk = []
+            chunk_bytes = 0
 
     if chunk:
         yield chunk
+
+
+def shard_of(item, shards):
+    """
+    Get shard of the item, the same item always belongs to the same shard
+    """
+    if shards == 1:
+        return 0
+
+    if not isinstance(item, bytes):
+        item = str(item).encode('utf-8')
+    return zlib.crc32(item) % shards
+
+
+def group_by_shard(items, shards):
+    """
+    :return: dict of shard index to list of its items
+    """
+    groups = {}
+    for item in items:
+        groups.setdefault(shard_of(item, shards), []).append(item)
+    return groups
+
+
+def weighted_round_robin(weights):
+    """
+    Smooth weighted round robin order of items
+    :param weights: iterable of (item, positive integer weight)
+    :return: generator of items, each item occurs weight times
+    """
+    weights = list(weights)
+    total = sum(weight for _, weight in weights)
+    current = [0] * len(weights)
+
+    for _ in range(total):
+        for index, (_, weight) in enumerate(weights):
+            current[index] += weight
+        best = current.index(max(current))
+        current[best] -= total
+        yield weights[best][0]
+
+
+def call_script(pipeline, script, keys, args):
+    """
+    Add call of the registered script to the pipeline, the same as script(keys=keys, args=args, client=pipeline)
+    but asyncio pipelines are supported too. Unlike the pipeline, which sends SCRIPT EXISTS on every execute,
+    the script is loaded with its registered client once per SCRIPT_LOAD_INTERVAL
+    """
+    if time.monotonic() - SCRIPT_LOADED.get(script, -SCRIPT_LOAD_INTERVAL) >= SCRIPT_LOAD_INTERVAL:
+        # cluster client loads the script to every primary node
+        script.sha = script.registered_client.script_load(script.script)
+        SCRIPT_LOADED[script] = time.monotonic()
+    return pipeline.evalsha(script.sha, len(keys), *keys, *args)
+
+
+def get_redis_client(redis_pool):
+    """
+    :param redis_pool: connection pool or redis client, for example redis.RedisCluster
+    :return: redis client
+    """
+    if isinstance(redis_pool, redis.ConnectionPool):
+        return redis.StrictRedis(connection_pool=redis_pool)
+    return redis_pool
+
+
+def is_cluster(redis_client):
+    return isinstance(redis_client, redis.RedisCluster)
+
+
+def get_pool(redis_client):
+    """
+    Commands of clients sharing the pool could be sent in a single round trip,
+    cluster client routes commands to its nodes itself
+    """
+    return getattr(redis_client, 'connection_pool', redis_client)
+
+
+def describe_many(jobs):
+    """
+    Get statistics of many jobs, jobs sharing redis connection pool are described in a single round trip
+    :param jobs: iterable of deferred or distributed jobs
+    :return: list of job statistics in the same order as jobs
+    """
+    jobs = list(jobs)
+    pipelines = {}
+    commands = []
+    for job in jobs:
+        pool = get_pool(job.redis_client)
+        if pool not in pipelines:
+            pipelines[pool] = job.redis_client.pipeline(transaction=False)
+
+        start = len(pipelines[pool])
+        job._describe_commands(pipelines[pool])
+        commands.append((pool, start, len(pipelines[pool])))
+
+    results = {pool: pipeline.execute() for pool, pipeline in pipelines.items()}
+    return [
+        job._parse_description(results[pool][start:end])
+        for job, (pool, start, end) in zip(jobs, commands)
+    ]
+
+
+def defer_many(jobs):
+    """
+    Defer a task of every job, jobs sharing redis connection pool are deferred in a single round trip.
+    Jobs other than deferred ones are deferred one by one
+    :param jobs: iterable of jobs, the same job could occur several times
+    """
+    pipelines = {}
+    for job in jobs:
+        if not hasattr(job, '_defer_commands'):
+            job.defer()
+            continue
+
+        pool = get_pool(job.redis_client)
+        if pool not in pipelines:
+            pipelines[pool] = job.redis_client.pipeline(transaction=False)
+        job._defer_commands(pipelines[pool])
+
+    for pipeline in pipelines.values():
+        pipeline.execute()
+
+
+def create_async_redis(redis_pool):
+    """
+    Create asyncio redis client connected to the same server as the pool,
+    tasks in flight wait for a free connection if pool limit is reached
+    """
+    from redis import asyncio as aioredis
+
+    connection_class = getattr(aioredis.connection, redis_pool.connection_class.__name__, aioredis.Connection)
+    return aioredis.StrictRedis(connection_pool=aioredis.BlockingConnectionPool(
+        connection_class=connection_class,
+        max_connections=redis_pool.max_connections,
+        timeout=None,
+        **redis_pool.connection_kwargs
+    ))